@@ -0,0 +1,362 @@
+"""Пакетная обработка изображений без графического интерфейса
+
+Применяет сохраненную историю действий (image_editing.save_history) ко всем изображениям из папок или по шаблонам
+путей. Модуль не импортирует PyQt5 и работает без дисплея.
+
+Файлы обрабатываются параллельно в пуле процессов: число процессов и число файлов в обработке одновременно
+ограничиваются, результаты возвращаются в порядке входных файлов. В потоковом режиме чтение, декодирование,
+редактирование и кодирование с записью выполняются одновременно в отдельных потоках, связанных очередями
+ограниченного размера, поэтому память не зависит от числа файлов. Очень большие изображения можно обрабатывать по
+тайлам (модуль tiling), тогда память зависит от размера тайла, а не от размера изображения. С кэшем (модуль
+image_cache) повторный запуск с теми же файлами и историей действий не декодирует и не редактирует их заново.
+
+Результаты можно экспортировать в другой формат (PNG, JPEG, WebP) с пресетом кодирования
+(image_editing.EXPORT_PRESETS) или заданным качеством. В потоковом режиме кодирование выполняется в нескольких
+потоках, потому что оно обычно самая медленная стадия, а OpenCV отпускает GIL на время cv2.imencode.
+"""
+import glob
+import os
+import queue
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import cv2
+import numpy
+
+from image_cache import ImageCache
+from image_editing import EditPipeline, encode_image, encode_params, history_from_dict, history_to_dict, \
+    load_history, read_image, render_history, write_file, write_image
+from tiling import render_file_tiled
+
+# Расширения файлов, которые берутся из папок, как в диалоге загрузки изображения
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+# Во сколько раз число файлов в обработке может превышать число процессов
+IN_FLIGHT_PER_WORKER = 2
+
+# Размер очереди между стадиями потокового режима по умолчанию
+STREAM_QUEUE_SIZE = 4
+# Число потоков кодирования в потоковом режиме по умолчанию, не больше числа ядер
+STREAM_ENCODE_THREADS = min(4, os.cpu_count() or 1)
+# Признак конца очереди в потоковом режиме
+_END = object()
+
+# Состояние процесса пула: история действий, EditPipeline, папка для результатов, размер тайла, ImageCache и
+# настройки экспорта
+_worker_state = None
+
+
+def collect_inputs(patterns):
+    """Возвращает отсортированный список файлов изображений из папок и шаблонов путей patterns без повторов"""
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths.extend(os.path.join(pattern, name) for name in os.listdir(pattern)
+                         if name.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            paths.extend(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+    return sorted(set(paths))
+
+
+def output_path(path, output_dir, output_format=None):
+    """Возвращает путь для сохранения результата обработки файла path в папке output_dir
+
+    output_format - расширение результата, например ".webp", по умолчанию результат в формате исходного файла.
+    """
+    name = os.path.basename(path)
+    if output_format is not None:
+        name = os.path.splitext(name)[0] + output_format
+    return os.path.join(output_dir, name)
+
+
+def export_target(path, output_dir, export=None):
+    """Возвращает путь к результату обработки файла path и параметры cv2.imencode для него
+
+    export - настройки экспорта: (расширение результата, пресет image_editing.EXPORT_PRESETS, качество), любое
+    значение может быть None. По умолчанию результат в формате исходного файла с настройками OpenCV.
+    """
+    output_format, preset, quality = export or (None, None, None)
+    target = output_path(path, output_dir, output_format)
+    return target, encode_params(target, preset, quality)
+
+
+def create_cache(cache_dir):
+    """Создает ImageCache для пакетной обработки в папке cache_dir или возвращает None, если папка не задана
+
+    Каждый файл обрабатывается один раз, поэтому изображения держатся только на диске, а не в памяти.
+    """
+    if cache_dir is None:
+        return None
+    return ImageCache(cache_dir, max_memory_bytes=0)
+
+
+def render_cached(key, image, history, pipeline=None, cache=None):
+    """Применяет историю действий к изображению с ключом кэша key, результат берется из кэша или сохраняется в него
+
+    image - изображение или функция без аргументов, которая его возвращает: она вызывается, только если результата
+    нет в кэше. Если изображение не удалось загрузить, вызывает ValueError.
+    """
+    if cache is not None:
+        result = cache.rendered(key, history)
+        if result is not None:
+            return result
+    if callable(image):
+        image = image()
+    if image is None:
+        raise ValueError(f"Ошибка загрузки изображения: {key}")
+    result = render_history(image, history, pipeline)
+    if cache is not None:
+        cache.store_rendered(key, history, result)
+    return result
+
+
+def process_file(path, output_dir, history, pipeline=None, tile_size=None, cache=None, export=None):
+    """Применяет историю действий к файлу path и сохраняет результат в output_dir
+
+    Если задан tile_size, изображение обрабатывается по тайлам такого размера (tiling.render_file_tiled). Если
+    задан cache (ImageCache), декодированное изображение и результат берутся из кэша или сохраняются в него.
+    export - настройки экспорта (export_target). Возвращает путь к результату. Если изображение не удалось
+    загрузить, вызывает ValueError.
+    """
+    target, params = export_target(path, output_dir, export)
+    if tile_size is not None:
+        source_path = path
+        if cache is not None:
+            source_path = cache.decoded_file(path) or path
+        render_file_tiled(source_path, target, history, tile_size, params)
+        return target
+    if cache is None:
+        image = read_image(path)
+        if image is None:
+            raise ValueError(f"Ошибка загрузки изображения: {path}")
+        result = render_history(image, history, pipeline)
+    else:
+        try:
+            result = render_cached(cache.file_key(path), lambda: cache.read_image(path), history, pipeline, cache)
+        except ValueError:
+            raise ValueError(f"Ошибка загрузки изображения: {path}") from None
+    write_image(target, result, params)
+    return target
+
+
+def _error_message(path, error):
+    """Возвращает сообщение об ошибке обработки файла path, для непредвиденных ошибок добавляет их тип"""
+    if isinstance(error, (OSError, ValueError, cv2.error)):
+        return str(error)
+    return f"Ошибка обработки {path}: {error!r}"
+
+
+def _init_worker(history_data, output_dir, tile_size=None, cache_dir=None, export=None):
+    """Подготавливает процесс пула: загружает историю действий и создает EditPipeline один раз на процесс"""
+    global _worker_state
+    # Каждый процесс обрабатывает свой файл, внутренние потоки OpenCV только конкурировали бы за ядра
+    cv2.setNumThreads(1)
+    history = history_from_dict(history_data)
+    _worker_state = (history, EditPipeline(max_cache_bytes=0, max_keyframe_bytes=0), output_dir, tile_size,
+                     create_cache(cache_dir), export)
+
+
+def _process_in_worker(path, state=None):
+    """Обрабатывает файл в процессе пула, возвращает (путь к результату, None) или (None, сообщение об ошибке)
+
+    state - состояние вида _worker_state, по умолчанию используется состояние процесса пула.
+    """
+    history, pipeline, output_dir, tile_size, cache, export = state or _worker_state
+    try:
+        return process_file(path, output_dir, history, pipeline, tile_size, cache, export), None
+    except Exception as error:
+        return None, _error_message(path, error)
+
+
+def process_files(paths, output_dir, history, workers=1, max_in_flight=None, tile_size=None, cache_dir=None,
+                  export=None):
+    """Применяет историю действий к файлам paths, возвращает генератор (путь, путь к результату, ошибка)
+
+    При workers > 1 файлы распределяются по пулу процессов. Одновременно в обработке находится не больше
+    max_in_flight файлов (по умолчанию IN_FLIGHT_PER_WORKER * workers), результаты возвращаются в порядке paths.
+    Для файла с ошибкой путь к результату равен None, а ошибка содержит сообщение, иначе ошибка равна None.
+    Если задан tile_size, файлы обрабатываются по тайлам такого размера, если задан cache_dir - используется кэш
+    в этой папке. export - настройки экспорта (export_target).
+    """
+    if workers <= 1:
+        state = (history, EditPipeline(max_cache_bytes=0, max_keyframe_bytes=0), output_dir, tile_size,
+                 create_cache(cache_dir), export)
+        for path in paths:
+            yield (path,) + _process_in_worker(path, state)
+        return
+
+    if max_in_flight is None:
+        max_in_flight = IN_FLIGHT_PER_WORKER * workers
+    max_in_flight = max(max_in_flight, 1)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(history_to_dict(history), output_dir, tile_size, cache_dir, export)) as executor:
+        in_flight = deque()
+        for path in paths:
+            if len(in_flight) >= max_in_flight:
+                done_path, future = in_flight.popleft()
+                yield (done_path,) + future.result()
+            in_flight.append((path, executor.submit(_process_in_worker, path)))
+        while in_flight:
+            done_path, future = in_flight.popleft()
+            yield (done_path,) + future.result()
+
+
+def _run_stage(function, source, target):
+    """Выполняет стадию потокового режима: берет элементы (путь, данные, ошибка) из source, передает в target
+
+    Элементы с ошибкой передаются дальше без обработки, любая ошибка function записывается в элемент. Признак конца
+    передается в target в любом случае, иначе следующие стадии ждали бы его бесконечно.
+    """
+    try:
+        for path, data, error in iter(source.get, _END):
+            if error is None:
+                try:
+                    data = function(path, data)
+                except Exception as stage_error:
+                    data, error = None, _error_message(path, stage_error)
+            target.put((path, data, error))
+    finally:
+        target.put(_END)
+
+
+def _run_parallel_stage(function, source, target, threads):
+    """Выполняет стадию потокового режима как _run_stage, но в нескольких потоках
+
+    Одновременно обрабатывается не больше threads элементов, в target они передаются в порядке source.
+    """
+    def result(path, future, error):
+        if future is None:
+            return path, None, error
+        try:
+            return path, future.result(), None
+        except Exception as stage_error:
+            return path, None, _error_message(path, stage_error)
+
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            in_flight = deque()
+            for path, data, error in iter(source.get, _END):
+                if len(in_flight) >= threads:
+                    target.put(result(*in_flight.popleft()))
+                future = executor.submit(function, path, data) if error is None else None
+                in_flight.append((path, future, error))
+            while in_flight:
+                target.put(result(*in_flight.popleft()))
+    finally:
+        target.put(_END)
+
+
+def stream_files(paths, output_dir, history, queue_size=None, cache_dir=None, export=None, encode_threads=None):
+    """Применяет историю действий к файлам paths потоком, возвращает генератор (путь, путь к результату, ошибка)
+
+    Чтение файла, cv2.imdecode, редактирование и cv2.imencode с записью выполняются в отдельных потоках, которые
+    связаны очередями размера queue_size (по умолчанию STREAM_QUEUE_SIZE), так что диск и процессор заняты
+    одновременно, а в памяти находится не больше нескольких изображений на стадию. OpenCV отпускает GIL, поэтому
+    стадии действительно выполняются параллельно. Кодирование с записью выполняется в encode_threads потоках (по
+    умолчанию STREAM_ENCODE_THREADS). Результаты возвращаются в порядке paths. Если задан cache_dir,
+    декодированные изображения и результаты берутся из кэша в этой папке или сохраняются в него. export -
+    настройки экспорта (export_target).
+    """
+    if queue_size is None:
+        queue_size = STREAM_QUEUE_SIZE
+    elif queue_size < 1:
+        # queue.Queue(maxsize=0) не ограничена, и память перестала бы зависеть только от размера очередей
+        raise ValueError(f"Неверный размер очереди: {queue_size}")
+    if encode_threads is None:
+        encode_threads = STREAM_ENCODE_THREADS
+    pipeline = EditPipeline(max_cache_bytes=0, max_keyframe_bytes=0)
+    cache = create_cache(cache_dir)
+
+    def read(path, _):
+        with open(path, "rb") as file:
+            return file.read()
+
+    def decode(path, in_bytes):
+        if cache is not None:
+            key, image = cache.decode(in_bytes)
+        else:
+            # Для правильной обработки кириллицы
+            key, image = None, cv2.imdecode(numpy.frombuffer(in_bytes, dtype=numpy.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError(f"Ошибка загрузки изображения: {path}")
+        return key, image
+
+    def edit(_, decoded):
+        key, image = decoded
+        return render_cached(key, image, history, pipeline, cache)
+
+    def encode_and_write(path, image):
+        target, params = export_target(path, output_dir, export)
+        write_file(target, encode_image(target, image, params))
+        return target
+
+    stages = [read, decode, edit, encode_and_write]
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    for stage, source, target in zip(stages, queues, queues[1:]):
+        if stage is encode_and_write and encode_threads > 1:
+            run, args = _run_parallel_stage, (stage, source, target, encode_threads)
+        else:
+            run, args = _run_stage, (stage, source, target)
+        # Потоки-демоны не мешают завершению программы, если генератор не дочитали до конца
+        threading.Thread(target=run, args=args, daemon=True).start()
+
+    def feed():
+        for path in paths:
+            queues[0].put((path, None, None))
+        queues[0].put(_END)
+
+    threading.Thread(target=feed, daemon=True).start()
+    for path, target, error in iter(queues[-1].get, _END):
+        yield path, target, error
+
+
+def run_batch(history_path, patterns, output_dir, workers=1, max_in_flight=None, stream=False, queue_size=None,
+              tile_size=None, cache_dir=None, output_format=None, preset=None, quality=None, encode_threads=None):
+    """Применяет историю действий из файла history_path ко всем изображениям patterns
+
+    workers - число процессов, max_in_flight - сколько файлов может находиться в обработке одновременно. При
+    stream=True файлы обрабатываются в одном процессе потоковым режимом с очередями размера queue_size. При
+    заданном tile_size каждый файл обрабатывается по тайлам, потоковый режим при этом не используется. При заданном
+    cache_dir декодированные изображения и результаты сохраняются в кэш в этой папке и берутся из него.
+    output_format ("png", "jpg", "jpeg" или "webp") задает формат результатов, по умолчанию формат исходного
+    файла, preset - пресет кодирования image_editing.EXPORT_PRESETS, quality - качество JPEG и WebP или степень
+    сжатия PNG вместо пресета, encode_threads - число потоков кодирования в потоковом режиме. Ошибки отдельных
+    файлов выводятся в stderr и не прерывают обработку. Возвращает код завершения: 0, если все файлы обработаны,
+    иначе 1.
+    """
+    try:
+        history = load_history(history_path)
+    except (OSError, ValueError) as error:
+        print(f"Ошибка загрузки истории действий: {error}", file=sys.stderr)
+        return 1
+    paths = collect_inputs(patterns)
+    if not paths:
+        print("Не найдено изображений для обработки", file=sys.stderr)
+        return 1
+    export = (None if output_format is None else f".{output_format.lower().lstrip('.')}", preset, quality)
+    targets = {}
+    try:
+        for path in paths:
+            target, _ = export_target(path, output_dir, export)
+            if target in targets:
+                raise ValueError(f"Результаты файлов {targets[target]} и {path} совпадают: {target}")
+            targets[target] = path
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        return 1
+    os.makedirs(output_dir, exist_ok=True)
+
+    if stream and tile_size is None:
+        results = stream_files(paths, output_dir, history, queue_size, cache_dir, export, encode_threads)
+    else:
+        results = process_files(paths, output_dir, history, workers, max_in_flight, tile_size, cache_dir, export)
+    failed = 0
+    for path, target, error in results:
+        if error is None:
+            print(target)
+        else:
+            failed += 1
+            print(error, file=sys.stderr)
+    print(f"Обработано: {len(paths) - failed}, ошибок: {failed}", file=sys.stderr)
+    return 1 if failed else 0
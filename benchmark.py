@@ -0,0 +1,330 @@
+"""Замеры производительности редактирования без графического интерфейса
+
+Для синтетических изображений разного размера и историй действий разной длины измеряется время операций, которые
+выполняют методы окна: load_image (быстрое открытие и загрузка полного разрешения), display_image (отрисовка
+истории для области отображения), rotate_image, crop_image и change_channel (одно новое действие после
+отрисованной истории), а также replay - применение всей истории в полном разрешении, как в пакетной обработке.
+Для каждой операции выводятся процентили задержки, пропускная способность и пиковая память процесса, результаты
+сохраняются в JSON и сравниваются с сохраненным ранее базовым замером:
+    python photo_editor.py benchmark --sizes 0.3 12 --histories 1 50 --output result.json --baseline base.json
+"""
+import gc
+import json
+import math
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from image_editing import CHANNELS, EditPipeline, OperationLog, build_steps, output_size, read_image, \
+    read_image_preview, write_image
+
+# Размеры синтетических изображений по умолчанию, в мегапикселях
+DEFAULT_SIZES = (0.3, 2, 12, 50)
+# Длины истории действий по умолчанию
+DEFAULT_HISTORIES = (1, 10, 50, 200)
+# Сколько раз выполняется каждая операция
+DEFAULT_REPEAT = 3
+# Во сколько раз медианное время может превысить базовое, прежде чем считается регрессией
+DEFAULT_THRESHOLD = 1.2
+# Область отображения окна
+PREVIEW_SIZE = (1000, 500)
+# Операции, время которых не зависит от истории действий
+LOAD_OPERATIONS = ("load_image", "load_full")
+# Операции над историей действий
+HISTORY_OPERATIONS = ("display_image", "rotate_image", "crop_image", "change_channel", "replay")
+# Все операции в порядке замера
+OPERATIONS = LOAD_OPERATIONS + HISTORY_OPERATIONS
+
+
+def image_shape(megapixels):
+    """Возвращает (ширину, высоту) изображения с соотношением сторон 3:2 и площадью megapixels мегапикселей"""
+    width = int(round(math.sqrt(megapixels * 1e6 * 3 / 2)))
+    return width, int(round(width * 2 / 3))
+
+
+def synthetic_image(width, height, seed=0):
+    """Создает воспроизводимое изображение с плавными переходами цвета, похожее на фотографию при сжатии"""
+    rng = np.random.default_rng(seed)
+    coarse = rng.integers(0, 256, (height // 32 + 2, width // 32 + 2, 3), dtype=np.uint8)
+    return cv2.resize(coarse, (width, height), interpolation=cv2.INTER_CUBIC)
+
+
+def synthetic_history(length, size):
+    """Создает воспроизводимый журнал действий длины length для изображения размера size
+
+    Действия чередуются: поворот, обрезка по центру до размера не больше исходного и прямоугольник, так что
+    размер изображения не растет с длиной истории.
+    """
+    operations = OperationLog()
+    width, height = size
+    current = size
+    for index in range(length):
+        kind = index % 3
+        if kind == 0:
+            operations.append("rotate", 5 + index % 20)
+        elif kind == 1:
+            new_width = max(1, min(current[0], width) - 2)
+            new_height = max(1, min(current[1], height) - 2)
+            x1 = (current[0] - new_width) // 2
+            y1 = (current[1] - new_height) // 2
+            operations.append("crop", (y1, y1 + new_height, x1, x1 + new_width))
+        else:
+            operations.append("draw", (current[1] // 4, current[1] // 2, current[0] // 4, current[0] // 2))
+        current = output_size(build_steps(operations.iterate(len(operations) - 1)), current)
+    return operations
+
+
+def reset_peak_rss():
+    """Сбрасывает пиковую память процесса, возвращает True, если система это поддерживает (Linux)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def current_rss():
+    """Возвращает текущую память процесса в байтах или 0, если узнать ее нельзя"""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def peak_rss():
+    """Возвращает пиковую память процесса в байтах с последнего сброса reset_peak_rss
+
+    Если узнать ее нельзя (модуля resource нет на Windows), возвращает 0.
+    """
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # ru_maxrss в килобайтах на Linux и в байтах на macOS, сбросить его нельзя
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def measure(function, repeat, setup=None):
+    """Выполняет function repeat раз, возвращает список задержек в секундах и пиковый прирост памяти в байтах
+
+    setup - функция без аргументов, вызывается перед каждым выполнением вне замера, ее результат передается в
+    function.
+    """
+    latencies = []
+    peak = 0
+    for _ in range(repeat):
+        argument = setup() if setup is not None else None
+        gc.collect()
+        reset_peak_rss()
+        start_rss = current_rss()
+        start = time.perf_counter()
+        function(argument)
+        latencies.append(time.perf_counter() - start)
+        peak = max(peak, peak_rss() - start_rss, 0)
+    return latencies, peak
+
+
+def summarize(operation, size, history, latencies, peak):
+    """Собирает результат замера операции в словарь для JSON"""
+    milliseconds = np.array(latencies) * 1000
+    mean = float(milliseconds.mean())
+    megapixels = size[0] * size[1] / 1e6
+    return {
+        "operation": operation,
+        "megapixels": round(megapixels, 2),
+        "width": size[0],
+        "height": size[1],
+        "history": history,
+        "repeat": len(latencies),
+        "latency_ms": {
+            "p50": float(np.percentile(milliseconds, 50)),
+            "p90": float(np.percentile(milliseconds, 90)),
+            "p99": float(np.percentile(milliseconds, 99)),
+            "mean": mean,
+            "min": float(milliseconds.min()),
+        },
+        "ops_per_s": 1000 / mean if mean else None,
+        "throughput_mp_s": megapixels * 1000 / mean if mean else None,
+        "peak_rss_mb": peak / 2 ** 20,
+    }
+
+
+def benchmark_loading(path, size, repeat, operations):
+    """Замеряет быстрое открытие файла path для отображения и загрузку полного разрешения"""
+    if "load_image" in operations:
+        yield summarize("load_image", size, 0, *measure(lambda _: read_image_preview(path, PREVIEW_SIZE), repeat))
+    if "load_full" in operations:
+        yield summarize("load_full", size, 0, *measure(lambda _: read_image(path), repeat))
+
+
+def benchmark_history(image, size, length, repeat, operations):
+    """Замеряет операции operations над историей действий длины length для изображения image"""
+    steps = build_steps(synthetic_history(length, size))
+
+    def cold_pipeline():
+        pipeline = EditPipeline()
+        pipeline.set_source(image)
+        return pipeline
+
+    if "display_image" in operations:
+        yield summarize("display_image", size, length, *measure(
+            lambda pipeline: pipeline.render(steps, "Без эффекта", PREVIEW_SIZE), repeat, cold_pipeline))
+
+    if {"rotate_image", "crop_image", "change_channel"} & set(operations):
+        # Новое действие после уже отрисованной истории, как при нажатии кнопки в окне
+        warm = cold_pipeline()
+        warm.render(steps, "Без эффекта", PREVIEW_SIZE)
+        current = output_size(steps, size)
+        angles = iter(range(1, repeat + 1))
+        margins = iter(range(1, repeat + 1))
+        channels = iter(CHANNELS[1 + index % (len(CHANNELS) - 1)] for index in range(repeat))
+
+        def crop_step(_):
+            margin = next(margins)
+            crop = (margin, max(margin + 1, current[1] - margin), margin, max(margin + 1, current[0] - margin))
+            warm.render(steps + [("crop", crop)], "Без эффекта", PREVIEW_SIZE)
+
+        if "rotate_image" in operations:
+            yield summarize("rotate_image", size, length, *measure(
+                lambda _: warm.render(steps + [("rotate", next(angles))], "Без эффекта", PREVIEW_SIZE), repeat))
+        if "crop_image" in operations:
+            yield summarize("crop_image", size, length, *measure(crop_step, repeat))
+        if "change_channel" in operations:
+            yield summarize("change_channel", size, length, *measure(
+                lambda _: warm.render(steps, next(channels), PREVIEW_SIZE), repeat))
+        del warm
+
+    def replay(_):
+        pipeline = EditPipeline(max_cache_bytes=0, max_keyframe_bytes=0)
+        pipeline.set_source(image)
+        pipeline.render(steps, "Красный")
+
+    if "replay" in operations:
+        yield summarize("replay", size, length, *measure(replay, repeat))
+
+
+def check_operations(operations):
+    """Возвращает список операций для замера, None - все операции. Для неизвестной операции вызывает ValueError"""
+    if operations is None:
+        return OPERATIONS
+    unknown = set(operations) - set(OPERATIONS)
+    if unknown:
+        raise ValueError(f"Неизвестные операции: {', '.join(sorted(unknown))}")
+    return operations
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, histories=DEFAULT_HISTORIES, repeat=DEFAULT_REPEAT, operations=None,
+                   report=None):
+    """Выполняет замеры для всех размеров sizes (в мегапикселях) и длин истории histories
+
+    operations - названия операций для замера, по умолчанию все (OPERATIONS). report - функция, которой
+    передается каждый результат сразу после замера. Возвращает словарь с описанием окружения, параметрами и
+    списком результатов. Для неизвестной операции вызывает ValueError.
+    """
+    operations = check_operations(operations)
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for megapixels in sizes:
+            size = image_shape(megapixels)
+            image = synthetic_image(*size)
+            cases = []
+            if set(operations) & set(LOAD_OPERATIONS):
+                path = os.path.join(temp_dir, "image.jpg")
+                write_image(path, image)
+                cases.append(benchmark_loading(path, size, repeat, operations))
+            cases.extend(benchmark_history(image, size, length, repeat, operations) for length in histories)
+            for case in cases:
+                for result in case:
+                    results.append(result)
+                    if report is not None:
+                        report(result)
+            del image
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "opencv_threads": cv2.getNumThreads(),
+        },
+        "settings": {"sizes": list(sizes), "histories": list(histories), "repeat": repeat,
+                     "operations": list(operations)},
+        "results": results,
+    }
+
+
+def _case_key(result):
+    """Возвращает ключ замера для сравнения с базовым: операция, размер и длина истории"""
+    return result["operation"], result["width"], result["height"], result["history"]
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """Сравнивает медианное время результатов results с базовым замером baseline
+
+    Возвращает список (результат, базовое медианное время, отношение, является ли регрессией) для замеров,
+    которые есть в обоих наборах. Регрессия - отношение больше threshold.
+    """
+    base = {_case_key(result): result for result in baseline["results"]}
+    comparison = []
+    for result in results["results"]:
+        previous = base.get(_case_key(result))
+        if previous is None:
+            continue
+        base_p50 = previous["latency_ms"]["p50"]
+        ratio = result["latency_ms"]["p50"] / base_p50 if base_p50 else math.inf
+        comparison.append((result, base_p50, ratio, ratio > threshold))
+    return comparison
+
+
+def format_result(result):
+    """Возвращает строку таблицы с результатом замера"""
+    latency = result["latency_ms"]
+    return (f"{result['operation']:<15}{result['megapixels']:>7} МП{result['history']:>9}"
+            f"{latency['p50']:>11.1f}{latency['p90']:>11.1f}{latency['p99']:>11.1f}"
+            f"{result['throughput_mp_s']:>11.1f}{result['peak_rss_mb']:>11.1f}")
+
+
+def run_benchmark(sizes=DEFAULT_SIZES, histories=DEFAULT_HISTORIES, repeat=DEFAULT_REPEAT, operations=None,
+                  output=None, baseline=None, threshold=DEFAULT_THRESHOLD):
+    """Выполняет замеры, выводит таблицу, сохраняет результаты в JSON-файл output и сравнивает с baseline
+
+    Возвращает код завершения: 1, если найдены регрессии относительно базового замера, иначе 0.
+    """
+    operations = check_operations(operations)
+    print(f"{'операция':<15}{'размер':>10}{'история':>9}{'p50, мс':>11}{'p90, мс':>11}{'p99, мс':>11}"
+          f"{'МП/с':>11}{'память, МБ':>11}")
+    results = run_benchmarks(sizes, histories, repeat, operations,
+                             report=lambda result: print(format_result(result), flush=True))
+    if output is not None:
+        with open(output, "w", encoding="utf-8") as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+    if baseline is None:
+        return 0
+
+    with open(baseline, encoding="utf-8") as file:
+        comparison = compare(results, json.load(file), threshold)
+    regressions = 0
+    print(f"\nСравнение с {baseline}:")
+    for result, base_p50, ratio, is_regression in comparison:
+        regressions += is_regression
+        mark = "  РЕГРЕССИЯ" if is_regression else ""
+        print(f"{result['operation']:<15}{result['megapixels']:>7} МП{result['history']:>9}"
+              f"{base_p50:>11.1f} -> {result['latency_ms']['p50']:.1f} мс (x{ratio:.2f}){mark}")
+    print(f"Регрессий: {regressions}", file=sys.stderr)
+    return 1 if regressions else 0
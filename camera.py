@@ -0,0 +1,156 @@
+"""Работа с веб-камерой без зависимости от интерфейса
+
+Содержит класс CaptureManager, который один раз находит работающую камеру, держит открытым одно подключение к ней
+и получает кадры из него, в том числе в фоновом потоке для живого просмотра.
+"""
+import threading
+from collections import deque
+
+import cv2
+
+# Сколько индексов устройств проверяется при поиске камеры
+CAMERA_INDEXES = 5
+# Сколько кадров живого просмотра хранится в буфере, более старые кадры отбрасываются
+PREVIEW_BUFFER_SIZE = 2
+# Сколько кадров пропускается перед снимком: драйвер копит кадры, пока подключение открыто, и первым отдает самый старый
+STALE_FRAMES = 4
+
+
+class CaptureManager:
+    """Класс управляет подключением к веб-камере
+
+    Индекс найденной камеры запоминается, подключение к ней остается открытым между снимками, проверенные при поиске
+    неработающие устройства освобождаются. Перед снимком накопленные драйвером кадры пропускаются, чтобы снимок не
+    оказался старым. В режиме живого просмотра кадры читаются в фоновом потоке в буфер
+    ограниченного размера: когда буфер заполнен, самый старый кадр отбрасывается.
+
+        Attributes
+        ----------
+        self.index : int
+            Индекс найденной камеры или None
+        self.capture : cv2.VideoCapture
+            Открытое подключение к камере или None
+        self.frames : deque
+            Буфер кадров живого просмотра
+
+        Methods
+        -------
+        open(self)
+            Находит камеру и открывает подключение, если оно еще не открыто
+        grab(self)
+            Возвращает снимок с камеры
+        start_preview(self)
+            Запускает чтение кадров в фоновом потоке
+        next_frame(self)
+            Возвращает следующий кадр живого просмотра из буфера
+        stop_preview(self)
+            Останавливает чтение кадров в фоновом потоке
+        release(self)
+            Останавливает живой просмотр и закрывает подключение к камере
+        """
+
+    def __init__(self, camera_indexes=CAMERA_INDEXES, buffer_size=PREVIEW_BUFFER_SIZE):
+        self.camera_indexes = camera_indexes
+        self.index = None
+        self.capture = None
+        self.frames = deque(maxlen=buffer_size)
+        self._last_frame = None
+        self._lock = threading.Lock()
+        self._preview_thread = None
+        self._preview_running = threading.Event()
+
+    def open(self):
+        """Находит камеру и открывает подключение, если оно еще не открыто
+
+        Сначала проверяется запомненный индекс, затем остальные. Возвращает True, если камера найдена.
+        """
+        if self.capture is not None and self.capture.isOpened():
+            return True
+        indexes = list(range(self.camera_indexes))
+        if self.index is not None:
+            indexes.remove(self.index)
+            indexes.insert(0, self.index)
+        for index in indexes:
+            capture = cv2.VideoCapture(index)
+            if capture.isOpened() and capture.read()[0]:
+                # Не все драйверы позволяют уменьшить буфер, остальные кадры пропускаются в grab
+                capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+                self.index = index
+                self.capture = capture
+                return True
+            capture.release()
+        self.index = None
+        self.capture = None
+        return False
+
+    def grab(self):
+        """Возвращает снимок с камеры или None, если камера не ответила
+
+        Во время живого просмотра возвращается последний прочитанный кадр. Если открытое подключение перестало
+        отдавать кадры, оно закрывается, а камера ищется заново.
+        """
+        if self.is_previewing():
+            with self._lock:
+                return self._last_frame
+        if not self.open():
+            return None
+        is_read, frame = self._read_current()
+        if not is_read:
+            self.release()
+            if not self.open():
+                return None
+            is_read, frame = self._read_current()
+        return frame if is_read else None
+
+    def _read_current(self):
+        """Пропускает накопленные в буфере драйвера кадры и читает текущий, возвращает результат capture.read"""
+        for _ in range(STALE_FRAMES):
+            if not self.capture.grab():
+                return False, None
+        return self.capture.read()
+
+    def is_previewing(self):
+        """Проверяет, идет ли живой просмотр"""
+        return self._preview_running.is_set()
+
+    def start_preview(self):
+        """Запускает чтение кадров в фоновом потоке, возвращает False, если камера не найдена"""
+        if self.is_previewing():
+            return True
+        if not self.open():
+            return False
+        self.frames.clear()
+        self._preview_running.set()
+        self._preview_thread = threading.Thread(target=self._read_frames, daemon=True)
+        self._preview_thread.start()
+        return True
+
+    def next_frame(self):
+        """Возвращает самый старый кадр из буфера живого просмотра или None, если новых кадров нет"""
+        with self._lock:
+            return self.frames.popleft() if self.frames else None
+
+    def stop_preview(self):
+        """Останавливает чтение кадров в фоновом потоке, подключение к камере остается открытым"""
+        self._preview_running.clear()
+        if self._preview_thread is not None:
+            self._preview_thread.join()
+            self._preview_thread = None
+
+    def release(self):
+        """Останавливает живой просмотр и закрывает подключение к камере"""
+        self.stop_preview()
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+
+    def _read_frames(self):
+        """Читает кадры в буфер, пока идет живой просмотр, выполняется в фоновом потоке"""
+        while self._preview_running.is_set():
+            is_read, frame = self.capture.read()
+            if not is_read:
+                self._preview_running.clear()
+                break
+            with self._lock:
+                self.frames.append(frame)
+                self._last_frame = frame
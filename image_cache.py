@@ -0,0 +1,279 @@
+"""Кэш декодированных изображений и результатов редактирования
+
+Изображения различаются по хэшу содержимого файла, а не по пути, поэтому переименованный или скопированный файл
+тоже находится в кэше, а измененный файл - нет. Декодированные изображения и результаты истории действий хранятся
+на диске в формате .npy и открываются отображением в память без декодирования, последние использованные также
+держатся в памяти. Оба уровня ограничены по размеру, первыми удаляются давно не использованные записи.
+"""
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from image_editing import decode_file, history_to_bytes
+from profiling import stage
+
+# Папка кэша по умолчанию
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "photo_editor")
+# Ограничение размера кэша на диске, в байтах
+DEFAULT_DISK_BYTES = 2 * 1024 * 1024 * 1024
+# Ограничение памяти под изображения кэша, в байтах
+DEFAULT_MEMORY_BYTES = 256 * 1024 * 1024
+# Размер хэша содержимого файла, в байтах
+DIGEST_SIZE = 16
+
+
+def content_hash(data):
+    """Вычисляет хэш содержимого: data - bytes или numpy.ndarray с байтами файла"""
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).hexdigest()
+
+
+def recipe_hash(history):
+    """Вычисляет хэш истории действий history (объект Image): цветового канала и журнала действий"""
+    return content_hash(history_to_bytes(history))
+
+
+class ImageCache:
+    """Кэш декодированных изображений и результатов редактирования по хэшу содержимого файла
+
+    Ключ декодированного изображения - хэш содержимого файла и флаги cv2.imdecode, ключ результата - тот же ключ и
+    хэш истории действий. Изображения из кэша на диске - numpy.memmap только для чтения, их нельзя изменять.
+    Несколько процессов могут пользоваться одной папкой кэша: файлы записываются во временный файл и атомарно
+    переименовываются. Ошибки записи на диск не прерывают работу, изображение просто не попадает в кэш.
+
+        Attributes
+        ----------
+        self.cache_dir : str
+            Папка кэша на диске
+        self.max_disk_bytes : int
+            Ограничение размера кэша на диске
+        self.max_memory_bytes : int
+            Ограничение памяти под изображения кэша, 0 - изображения не держатся в памяти
+
+        Methods
+        -------
+        file_key(self, path, flags=cv2.IMREAD_COLOR, read_file=True)
+            Возвращает ключ декодированного изображения для файла path
+        cached_image(self, path, flags=cv2.IMREAD_COLOR, read_file=True)
+            Возвращает декодированное изображение из кэша или None
+        load_file(self, path, flags=cv2.IMREAD_COLOR)
+            Возвращает ключ и декодированное изображение из кэша или декодирует файл, не сохраняя его в кэш
+        read_image(self, path, flags=cv2.IMREAD_COLOR)
+            Возвращает декодированное изображение из кэша или декодирует файл и сохраняет в кэш
+        decode(self, data, flags=cv2.IMREAD_COLOR)
+            Возвращает ключ и декодированное изображение для содержимого файла data
+        decoded_file(self, path, flags=cv2.IMREAD_COLOR)
+            Возвращает путь к файлу .npy с декодированным изображением
+        store_image(self, key, image)
+            Сохраняет декодированное изображение в кэш
+        store_file_image(self, path, image, flags=cv2.IMREAD_COLOR)
+            Сохраняет декодированное изображение файла path в кэш, если его там нет
+        rendered(self, key, history) / store_rendered(self, key, history, image)
+            Возвращает и сохраняет результат истории действий для изображения с ключом key
+        """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_disk_bytes=DEFAULT_DISK_BYTES,
+                 max_memory_bytes=DEFAULT_MEMORY_BYTES):
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        # Хэши файлов по (пути, размеру, времени изменения), чтобы не читать неизмененный файл повторно
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    def file_key(self, path, flags=cv2.IMREAD_COLOR, read_file=True):
+        """Возвращает ключ декодированного изображения для файла path: хэш содержимого и флаги декодирования
+
+        read_file=False - не читать файл: если хэш неизмененного файла еще не вычислялся, возвращает None.
+        """
+        stat = os.stat(path)
+        file_id = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            digest = self._hashes.get(file_id)
+        if digest is None:
+            if not read_file:
+                return None
+            digest = decode_file(path, content_hash) or content_hash(b"")
+            with self._lock:
+                self._hashes[file_id] = digest
+        return f"{digest}-{flags}"
+
+    def cached_image(self, path, flags=cv2.IMREAD_COLOR, read_file=True):
+        """Возвращает декодированное изображение файла path из кэша или None, если его там нет
+
+        read_file=False - не читать файл для вычисления хэша, тогда изображение ищется, только если хэш уже известен.
+        Так проверка не задерживает поток интерфейса чтением большого файла.
+        """
+        key = self.file_key(path, flags, read_file)
+        return None if key is None else self._load(key)
+
+    def load_file(self, path, flags=cv2.IMREAD_COLOR):
+        """Возвращает ключ, декодированное изображение файла path и признак, найдено ли оно в кэше
+
+        Отсутствующее в кэше изображение декодируется, но не сохраняется: его можно сохранить позже через
+        store_image, чтобы запись на диск не задерживала использование изображения. Если файл не удалось
+        декодировать, изображение равно None.
+        """
+        key = self.file_key(path, flags)
+        image = self._load(key)
+        if image is not None:
+            return key, image, True
+        with stage("decode", path=os.path.basename(path)):
+            image = decode_file(path, lambda data: cv2.imdecode(data, flags))
+        return key, image, False
+
+    def read_image(self, path, flags=cv2.IMREAD_COLOR):
+        """Возвращает декодированное изображение файла path, при отсутствии в кэше декодирует и сохраняет его
+
+        Возвращает None, если файл не удалось декодировать.
+        """
+        key, image, is_cached = self.load_file(path, flags)
+        if image is not None and not is_cached:
+            self.store_image(key, image)
+        return image
+
+    def decode(self, data, flags=cv2.IMREAD_COLOR):
+        """Возвращает ключ и декодированное изображение для содержимого файла data (bytes или numpy.ndarray)
+
+        При отсутствии в кэше изображение декодируется и сохраняется. Если декодировать не удалось, изображение
+        равно None.
+        """
+        key = f"{content_hash(data)}-{flags}"
+        image = self._load(key)
+        if image is None:
+            with stage("decode"):
+                image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+            if image is not None:
+                self.store_image(key, image)
+        return key, image
+
+    def decoded_file(self, path, flags=cv2.IMREAD_COLOR):
+        """Возвращает путь к файлу .npy с декодированным изображением файла path, чтобы отобразить его в память
+
+        При отсутствии в кэше файл декодируется и сохраняется, изображение при этом не держится в памяти. Если файл
+        не удалось декодировать или сохранить, возвращает None.
+        """
+        key = self.file_key(path, flags)
+        cache_path = self._path(key)
+        if os.path.exists(cache_path):
+            self._touch(cache_path)
+            return cache_path
+        image = decode_file(path, lambda data: cv2.imdecode(data, flags))
+        if image is None or not self._write(key, image):
+            return None
+        return cache_path
+
+    def store_image(self, key, image):
+        """Сохраняет декодированное изображение с ключом key в кэш на диске и в памяти"""
+        self._write(key, image)
+        self._remember(key, image)
+
+    def store_file_image(self, path, image, flags=cv2.IMREAD_COLOR):
+        """Сохраняет декодированное изображение файла path в кэш, если его там еще нет
+
+        Хэш файла вычисляется здесь, поэтому метод стоит вызывать в фоновом потоке.
+        """
+        key = self.file_key(path, flags)
+        if not os.path.exists(self._path(key)):
+            self.store_image(key, image)
+
+    def rendered(self, key, history):
+        """Возвращает результат истории действий history для изображения с ключом key или None"""
+        return self._load(f"{key}-{recipe_hash(history)}")
+
+    def store_rendered(self, key, history, image):
+        """Сохраняет результат истории действий history для изображения с ключом key"""
+        self.store_image(f"{key}-{recipe_hash(history)}", image)
+
+    def _path(self, key):
+        """Возвращает путь к файлу кэша с ключом key"""
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def _load(self, key):
+        """Ищет изображение с ключом key в памяти, затем на диске, возвращает его или None"""
+        with self._lock:
+            image = self._memory.get(key)
+            if image is not None:
+                self._memory.move_to_end(key)
+                return image
+        cache_path = self._path(key)
+        try:
+            image = np.load(cache_path, mmap_mode="r")
+        except (OSError, ValueError):
+            # Записи нет или файл поврежден
+            return None
+        self._touch(cache_path)
+        self._remember(key, image)
+        return image
+
+    def _remember(self, key, image):
+        """Запоминает изображение в памяти, удаляя давно не использованные, пока не хватит места"""
+        if image.nbytes > self.max_memory_bytes:
+            return
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= previous.nbytes
+            while self._memory and self._memory_bytes + image.nbytes > self.max_memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted.nbytes
+            self._memory[key] = image
+            self._memory_bytes += image.nbytes
+
+    def _write(self, key, image):
+        """Записывает изображение в кэш на диске, возвращает True, если запись удалась"""
+        if image.nbytes > self.max_disk_bytes:
+            return False
+        cache_path = self._path(key)
+        temp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with stage("cache_write"), open(temp_path, "wb") as file:
+                np.save(file, image)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return False
+        self._evict()
+        return True
+
+    def _touch(self, cache_path):
+        """Отмечает файл кэша как использованный, время изменения файла служит временем последнего использования"""
+        try:
+            os.utime(cache_path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        """Удаляет давно не использованные файлы кэша, пока размер кэша на диске превышает ограничение"""
+        entries = []
+        total = 0
+        with os.scandir(self.cache_dir) as scan:
+            for entry in scan:
+                if not entry.name.endswith(".npy"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # Файл удален другим процессом
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                total += stat.st_size
+        entries.sort()
+        for _, size, cache_path in entries:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(cache_path)
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,1165 @@
+"""Операции редактирования изображения, не зависящие от интерфейса
+
+Содержит функции обрезки, поворота и смены цветового канала над numpy.ndarray, векторный слой синих прямоугольников
+AnnotationLayer, класс EditPipeline, который применяет историю действий и кэширует промежуточные результаты, класс
+Image с журналом действий OperationLog и функции сохранения и загрузки истории действий.
+"""
+import json
+import math
+import mmap
+import os
+import struct
+import uuid
+import zlib
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from profiling import stage
+
+# Ограничение памяти под кэш промежуточных результатов EditPipeline, в байтах
+DEFAULT_CACHE_BYTES = 512 * 1024 * 1024
+# Ограничение памяти под сжатые опорные кадры EditPipeline, в байтах
+DEFAULT_KEYFRAME_BYTES = 64 * 1024 * 1024
+# Результат какого по счету шага сохраняется как опорный кадр
+DEFAULT_KEYFRAME_INTERVAL = 4
+# Толщина линии синего прямоугольника на изображении в исходном разрешении
+RECTANGLE_THICKNESS = 3
+# Цвет прямоугольников в порядке BGR
+RECTANGLE_COLOR = (255, 0, 0)
+# Число дробных бит координат отрезков при растеризации слоя прямоугольников (параметр shift cv2.polylines)
+ANNOTATION_SHIFT = 4
+# Цветовые каналы в порядке кодов двоичного формата истории действий
+CHANNELS = ("Без эффекта", "Красный", "Зеленый", "Синий")
+# Коды действий двоичного формата журнала и форматы записей: код действия, затем параметры
+OPERATION_CODES = {"crop": 0, "rotate": 1, "draw": 2}
+OPERATION_ACTIONS = {code: action for action, code in OPERATION_CODES.items()}
+OPERATION_FORMATS = {
+    0: struct.Struct("<B4i"),
+    1: struct.Struct("<Bd"),
+    2: struct.Struct("<B4i"),
+}
+OPERATION_COUNT_FORMAT = struct.Struct("<I")
+# Заголовок двоичного файла истории действий, включает номер версии формата
+HISTORY_MAGIC = b"PEHIST1\n"
+# Маркеры начала кадра JPEG (SOF), содержащие размер изображения
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Флаги декодирования в уменьшенном разрешении: во сколько раз уменьшить -> флаг cv2.imdecode
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+# Маски цветовых каналов в порядке BGR, остальные каналы обнуляются
+CHANNEL_MASKS = {
+    "Красный": (0, 0, 255, 0),
+    "Зеленый": (0, 255, 0, 0),
+    "Синий": (255, 0, 0, 0),
+}
+# Пресеты кодирования при экспорте: название -> (степень сжатия PNG 0-9, качество JPEG 0-100, качество WebP 1-100,
+# больше 100 - WebP без потерь). Для PNG сжатие без потерь всегда, пресет меняет только размер файла и скорость.
+EXPORT_PRESETS = {
+    "fast": (1, 90, 80),
+    "balanced": (3, 95, 90),
+    "small": (9, 80, 70),
+    "best": (6, 100, 101),
+}
+# Пресет экспорта из интерфейса по умолчанию
+DEFAULT_EXPORT_PRESET = "balanced"
+# Форматы экспорта: расширение -> параметр cv2.imencode, который задает пресет, и допустимый диапазон значения
+EXPORT_FORMATS = {
+    ".png": (cv2.IMWRITE_PNG_COMPRESSION, 0, 9),
+    ".jpg": (cv2.IMWRITE_JPEG_QUALITY, 0, 100),
+    ".jpeg": (cv2.IMWRITE_JPEG_QUALITY, 0, 100),
+    ".webp": (cv2.IMWRITE_WEBP_QUALITY, 1, 101),
+}
+
+
+def crop(image, coordinates):
+    """Обрезает изображение по координатам [y1, y2, x1, x2]
+
+    Возвращает копию, чтобы результат в кэше не удерживал в памяти исходный массив.
+    """
+    y1, y2, x1, x2 = coordinates
+    return image[y1:y2, x1:x2].copy()
+
+
+def rotation_matrix(width, height, angel):
+    """Вычисляет матрицу поворота изображения размера width x height на угол angel
+
+    Для корректного отображения без обрезания сторон, длина и ширина изображения меняются. Возвращает матрицу 2x3
+    и новые ширину и высоту изображения.
+    """
+    centre = (width // 2, height // 2)
+
+    matrix = cv2.getRotationMatrix2D(centre, angel, 1)
+
+    cos_of_rotation_matrix = np.abs(matrix[0][0])
+    sin_of_rotation_matrix = np.abs(matrix[0][1])
+
+    new_image_height = int((height * cos_of_rotation_matrix) +
+                           (width * sin_of_rotation_matrix))
+    new_image_width = int((height * sin_of_rotation_matrix) +
+                          (width * cos_of_rotation_matrix))
+
+    matrix[0][2] += (new_image_width - width) / 2
+    matrix[1][2] += (new_image_height - height) / 2
+
+    return matrix, new_image_width, new_image_height
+
+
+def rotate(image, angel):
+    """Поворачивает изображение на угол angel, увеличивая размер изображения, чтобы не обрезать стороны"""
+    height, width = image.shape[:2]
+    matrix, new_image_width, new_image_height = rotation_matrix(width, height, angel)
+    return cv2.warpAffine(image, matrix, (new_image_width, new_image_height))
+
+
+def mask_spans(mask, top, height):
+    """Находит пиксели строк top, ..., top + height - 1, центры которых лежат внутри выпуклого многоугольника mask
+
+    Возвращает массивы начал и концов (не включая) отрезков пикселей в каждой строке, для строк вне многоугольника
+    начало не меньше конца. Вычисление не зависит от того, какая часть изображения обрабатывается, поэтому тайлы
+    закрашиваются так же, как все изображение.
+    """
+    rows = np.arange(top, top + height, dtype=np.float64)[:, None]
+    points = np.array(mask, dtype=np.float64)
+    x0, y0 = points[:, 0], points[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    is_sloped = y0 != y1
+    x0, y0, x1, y1 = x0[is_sloped], y0[is_sloped], x1[is_sloped], y1[is_sloped]
+    # Точки пересечения строки со сторонами многоугольника
+    position = (rows - y0) / (y1 - y0)
+    crossing = x0 + position * (x1 - x0)
+    is_crossed = (position >= 0) & (position <= 1)
+    starts = np.ceil(np.where(is_crossed, crossing, np.inf).min(axis=1, initial=np.inf))
+    stops = np.floor(np.where(is_crossed, crossing, -np.inf).max(axis=1, initial=-np.inf)) + 1
+    return starts, stops
+
+
+def fill_outside(image, masks, left=0, top=0):
+    """Закрашивает черным пиксели image вне выпуклых многоугольников masks
+
+    (left, top) - координаты левого верхнего пикселя image в системе координат многоугольников. Пересечение
+    выпуклых многоугольников в каждой строке - один отрезок пикселей, поэтому отрезки всех многоугольников
+    пересекаются заранее, а изображение закрашивается за один проход по общей маске.
+    """
+    if not masks:
+        return
+    height, width = image.shape[:2]
+    starts = np.full(height, -np.inf)
+    stops = np.full(height, np.inf)
+    for mask in masks:
+        mask_starts, mask_stops = mask_spans(mask, top, height)
+        np.maximum(starts, mask_starts, out=starts)
+        np.minimum(stops, mask_stops, out=stops)
+    starts = np.clip(starts - left, 0, width)
+    stops = np.clip(stops - left, 0, width)
+    if (starts == 0).all() and (stops == width).all():
+        return
+    columns = np.arange(width)
+    inside = (columns >= starts[:, None]) & (columns < stops[:, None])
+    np.multiply(image, inside.reshape(inside.shape + (1,) * (image.ndim - 2)), out=image)
+
+
+def warp(image, parameters):
+    """Выполняет подряд идущие обрезки и повороты одним вызовом cv2.warpAffine
+
+    parameters: (область входного изображения [y1, y2, x1, x2], матрица 2x3 в виде кортежа из 6 чисел, ширина и
+    высота результата, многоугольники обрезок между поворотами). Все, что лежит вне многоугольников, закрашивается
+    черным, как если бы обрезка и поворот выполнялись по отдельности.
+    """
+    (y1, y2, x1, x2), matrix, width, height, masks = parameters
+    if width == 0 or height == 0:
+        return np.zeros((height, width) + image.shape[2:], dtype=image.dtype)
+    matrix = np.array(matrix, dtype=np.float64).reshape(2, 3)
+    result = cv2.warpAffine(image[y1:y2, x1:x2], matrix, (width, height))
+    fill_outside(result, masks)
+    return result
+
+
+def apply_channel(image, channel, out=None):
+    """Оставляет в изображении только выбранный цветовой канал
+
+    channel: "Красный", "Зеленый", "Синий" или "Без эффекта" - изображение возвращается без изменений.
+    Остальные каналы обнуляются побитовым "и" с маской за один проход, без разделения на каналы. Результат
+    записывается в out, если его размер совпадает с размером изображения, иначе создается новый массив.
+    """
+    mask = CHANNEL_MASKS.get(channel)
+    if mask is None:
+        return image
+    if out is None or out.shape != image.shape or out.dtype != image.dtype:
+        out = np.empty_like(image)
+    return cv2.bitwise_and(image, mask, dst=out)
+
+
+def annotation_color(channel):
+    """Возвращает цвет прямоугольников после смены цветового канала: синий или черный, если синий канал обнулен"""
+    mask = CHANNEL_MASKS.get(channel)
+    if mask is None:
+        return RECTANGLE_COLOR
+    return tuple(value & bits for value, bits in zip(RECTANGLE_COLOR, mask))
+
+
+OPERATIONS = {
+    "crop": crop,
+    "rotate": rotate,
+    "warp": warp,
+}
+
+
+def build_steps(operations):
+    """Собирает список шагов редактирования из журнала действий OperationLog
+
+    Возвращает список кортежей (действие, параметры), где параметры - неизменяемые значения, пригодные для ключа
+    кэша. К координатам прямоугольника добавляется толщина линии.
+    """
+    steps = []
+    for operation in operations:
+        value = operation.value
+        if operation.action == "draw":
+            value = value + (RECTANGLE_THICKNESS,)
+        steps.append((operation.action, value))
+    return steps
+
+
+def _scale_bounds(start, stop, scale):
+    """Переводит границы среза [start:stop] в масштаб scale так, чтобы непустой срез не стал пустым
+
+    Начало округляется вниз, конец - вверх, но не меньше чем на пиксель дальше начала.
+    """
+    if stop <= start:
+        return int(round(start * scale)), int(round(stop * scale))
+    scaled_start = math.floor(start * scale)
+    return scaled_start, max(scaled_start + 1, math.ceil(stop * scale))
+
+
+def scale_step(step, scale):
+    """Переводит параметры шага в пространство изображения, уменьшенного в 1 / scale раз"""
+    action, value = step
+    if action == "crop":
+        y1, y2, x1, x2 = value
+        return action, _scale_bounds(y1, y2, scale) + _scale_bounds(x1, x2, scale)
+    if action == "draw":
+        coordinates = tuple(int(round(v * scale)) for v in value[:4])
+        return action, coordinates + (max(1, int(round(value[4] * scale))),)
+    return step
+
+
+def output_size(steps, size):
+    """Вычисляет размер результата шагов без обработки пикселей
+
+    size: (ширина, высота) исходного изображения. Возвращает (ширину, высоту) результата.
+    """
+    width, height = size
+    for action, value in steps:
+        if action == "crop":
+            y1, y2, x1, x2 = value
+            # Те же правила, что у срезов numpy.ndarray в crop
+            height = len(range(height)[y1:y2])
+            width = len(range(width)[x1:x2])
+        elif action == "rotate":
+            _, width, height = rotation_matrix(width, height, value)
+    return width, height
+
+
+def _slice_bounds(start, stop, length):
+    """Возвращает начало и длину среза [start:stop] у оси длины length"""
+    start, stop, _ = slice(start, stop).indices(length)
+    return start, max(0, stop - start)
+
+
+def _fuse(run, width, height):
+    """Объединяет подряд идущие обрезки и повороты в одну операцию
+
+    Обрезки до первого поворота становятся срезом входного изображения, повороты и последующие обрезки
+    перемножаются в одну аффинную матрицу. Обрезки, после которых есть поворот, запоминаются как многоугольники в
+    координатах результата. Возвращает шаг и (ширину, высоту) результата.
+    """
+    left, top = 0, 0
+    index = 0
+    while index < len(run) and run[index][0] == "crop":
+        y1, y2, x1, x2 = run[index][1]
+        x1, width = _slice_bounds(x1, x2, width)
+        y1, height = _slice_bounds(y1, y2, height)
+        left += x1
+        top += y1
+        index += 1
+    area = (top, top + height, left, left + width)
+    if index == len(run):
+        return ("crop", area), (width, height)
+
+    matrix = np.eye(3)
+    masks = []
+    needed_masks = 0
+    for action, value in run[index:]:
+        if action == "crop":
+            y1, y2, x1, x2 = value
+            x1, new_width = _slice_bounds(x1, x2, width)
+            y1, new_height = _slice_bounds(y1, y2, height)
+            # Границы пикселей обрезанной области относительно центров пикселей
+            masks.append(np.array([[x1, y1], [x1 + new_width, y1], [x1 + new_width, y1 + new_height],
+                                   [x1, y1 + new_height]], dtype=np.float64) - 0.5)
+            step_matrix = np.array([[1, 0, -x1], [0, 1, -y1], [0, 0, 1]], dtype=np.float64)
+            width, height = new_width, new_height
+        else:
+            rotation, width, height = rotation_matrix(width, height, value)
+            step_matrix = np.vstack([rotation, [0, 0, 1]])
+            needed_masks = len(masks)
+        matrix = step_matrix @ matrix
+        masks = [mask @ step_matrix[:2, :2].T + step_matrix[:2, 2] for mask in masks]
+
+    # Обрезки после последнего поворота совпадают с границами результата и не требуют закрашивания
+    masks = tuple(tuple(map(tuple, mask.round(3))) for mask in masks[:needed_masks])
+    parameters = (area, tuple(matrix[:2].ravel()), width, height, masks)
+    return ("warp", parameters), (width, height)
+
+
+def compile_steps(steps, size):
+    """Объединяет подряд идущие обрезки и повороты, чтобы изображение пересчитывалось один раз на группу
+
+    size: (ширина, высота) входного изображения. Каждая группа геометрических шагов заменяется одним шагом "warp",
+    или "crop", если в группе нет поворотов. Размер результата совпадает с output_size, поворот по-прежнему
+    увеличивает размер изображения, чтобы не обрезать стороны.
+    """
+    compiled = []
+    run = []
+    width, height = size
+    for step in steps:
+        if step[0] in ("crop", "rotate"):
+            run.append(step)
+            continue
+        if run:
+            fused, (width, height) = _fuse(run, width, height)
+            compiled.append(fused)
+            run = []
+        compiled.append(step)
+    if run:
+        fused, _ = _fuse(run, width, height)
+        compiled.append(fused)
+    return compiled
+
+
+def _clip_segments(segments, left, top, right, bottom):
+    """Обрезает отрезки прямоугольником [left, right] x [top, bottom] (алгоритм Лианга - Барски)
+
+    segments: массив (N, 2, 2) концов отрезков (x, y). Границы - числа или массивы (N,) своих границ для каждого
+    отрезка. Возвращает обрезанные отрезки, оставшиеся хотя бы частично
+    внутри прямоугольника, и булеву маску этих отрезков среди исходных.
+    """
+    start = segments[:, 0]
+    delta = segments[:, 1] - start
+    low = np.zeros(len(segments))
+    high = np.ones(len(segments))
+    inside = np.ones(len(segments), dtype=bool)
+    bounds = ((-delta[:, 0], start[:, 0] - left), (delta[:, 0], right - start[:, 0]),
+              (-delta[:, 1], start[:, 1] - top), (delta[:, 1], bottom - start[:, 1]))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for direction, distance in bounds:
+            ratio = distance / direction
+            # Отрезок параллелен границе и лежит снаружи
+            inside &= (direction != 0) | (distance >= 0)
+            low = np.where(direction < 0, np.maximum(low, ratio), low)
+            high = np.where(direction > 0, np.minimum(high, ratio), high)
+    inside &= low <= high
+    clipped = np.stack([start + low[:, None] * delta, start + high[:, None] * delta], axis=1)
+    return clipped[inside], inside
+
+
+class AnnotationLayer:
+    """Векторный слой синих прямоугольников поверх результата геометрических шагов
+
+    Прямоугольники не рисуются в пиксели по ходу истории действий: их стороны хранятся как отрезки в массиве
+    numpy и переводятся в координаты результата последующими обрезками и поворотами. Обрезка отсекает части
+    отрезков вне оставленной области, поворот умножает концы отрезков на ту же матрицу, что и пиксели. Слой
+    растеризуется одним вызовом cv2.polylines на каждую толщину линии, поэтому новые прямоугольники не требуют
+    пересчета изображения, а время отрисовки слабо зависит от их числа.
+
+        Attributes
+        ----------
+        self.segments : numpy.ndarray
+            Отрезки (N, 2, 2): концы (x, y) в координатах результата
+        self.thickness : numpy.ndarray
+            Толщина линии каждого отрезка в пикселях результата
+
+        Methods
+        -------
+        from_steps(cls, steps, size)
+            Собирает слой из прямоугольников шагов "draw" с учетом последующих обрезок и поворотов
+        draw(self, image, color, offset=(0, 0))
+            Растеризует слой на изображении
+        """
+
+    def __init__(self, segments=None, thickness=None):
+        self.segments = np.empty((0, 2, 2)) if segments is None else segments
+        self.thickness = np.empty(0, dtype=np.int32) if thickness is None else thickness
+
+    def __len__(self):
+        return len(self.segments)
+
+    @classmethod
+    def from_steps(cls, steps, size):
+        """Собирает слой из шагов build_steps для входного изображения размера size (ширина, высота)
+
+        Шаги "draw" идут в слой, обрезки и повороты переводят уже собранные отрезки в свои координаты. Размер
+        результата совпадает с output_size.
+        """
+        layer = cls()
+        width, height = size
+        rectangles = []
+        for action, value in steps:
+            if action == "draw":
+                rectangles.append(value)
+                continue
+            if rectangles:
+                layer._add_rectangles(rectangles)
+                rectangles = []
+            if action == "crop":
+                y1, y2, x1, x2 = value
+                x1, width = _slice_bounds(x1, x2, width)
+                y1, height = _slice_bounds(y1, y2, height)
+                # Границы пикселей оставленной области относительно центров пикселей, расширенные на половину
+                # толщины линии: часть толстой линии внутри области может рисовать отрезок, лежащий снаружи
+                margin = layer.thickness / 2
+                segments, inside = _clip_segments(layer.segments, x1 - 0.5 - margin, y1 - 0.5 - margin,
+                                                  x1 + width - 0.5 + margin, y1 + height - 0.5 + margin)
+                layer.segments = segments - (x1, y1)
+                layer.thickness = layer.thickness[inside]
+            elif action == "rotate":
+                matrix, width, height = rotation_matrix(width, height, value)
+                layer.segments = layer.segments @ matrix[:, :2].T + matrix[:, 2]
+        if rectangles:
+            layer._add_rectangles(rectangles)
+        return layer
+
+    def _add_rectangles(self, rectangles):
+        """Добавляет стороны прямоугольников [y1, y2, x1, x2, толщина линии] в слой"""
+        values = np.array(rectangles, dtype=np.float64).reshape(-1, 5)
+        y1, y2, x1, x2 = values[:, 0], values[:, 1], values[:, 2], values[:, 3]
+        corners = np.stack([np.stack([x1, y1], axis=1), np.stack([x2, y1], axis=1),
+                            np.stack([x2, y2], axis=1), np.stack([x1, y2], axis=1)], axis=1)
+        segments = np.stack([corners, np.roll(corners, -1, axis=1)], axis=2).reshape(-1, 2, 2)
+        self.segments = np.concatenate([self.segments, segments])
+        self.thickness = np.concatenate([self.thickness, np.repeat(values[:, 4].astype(np.int32), 4)])
+
+    def draw(self, image, color, offset=(0, 0)):
+        """Растеризует слой на изображении image на месте
+
+        offset: координаты (x, y) левого верхнего угла image в результате, если image - его тайл.
+        """
+        if not len(self):
+            return image
+        points = np.round((self.segments - offset) * (1 << ANNOTATION_SHIFT)).astype(np.int32)
+        for thickness in np.unique(self.thickness):
+            cv2.polylines(image, points[self.thickness == thickness], False, color, int(thickness),
+                          shift=ANNOTATION_SHIFT)
+        return image
+
+
+class EditPipeline:
+    """Класс применяет историю действий к исходному изображению, пересчитывая только изменившиеся шаги
+
+    Прямоугольники не участвуют в пересчете пикселей: они собираются в векторный слой AnnotationLayer и рисуются
+    поверх результата после смены цветового канала, поэтому добавление прямоугольника не сбрасывает кэш. Остальные
+    шаги перед выполнением объединяются: подряд идущие обрезки и повороты становятся одним шагом (compile_steps),
+    поэтому изображение пересчитывается один раз на группу. Результат хранится в кэше с ключом из всех шагов
+    истории до него, поэтому при добавлении или изменении действия вычисления начинаются с последнего сохраненного
+    результата, и объединяются только шаги после него. Кэш ограничен по памяти, при превышении удаляются давно не
+    использованные результаты (LRU).
+
+    Кроме того, вычисленный результат истории из числа обрезок и поворотов, кратного keyframe_interval, сохраняется
+    в сжатом виде как опорный кадр. Опорные кадры занимают мало памяти и живут дольше результатов в кэше, поэтому
+    при отмене действий результат восстанавливается от ближайшего опорного кадра, а не вычисляется заново от
+    исходного изображения. Память под опорные кадры ограничена max_keyframe_bytes.
+
+    Для предпросмотра шаги выполняются над уменьшенной копией исходного изображения (прокси), масштаб которой
+    подбирается по размеру области отображения, поэтому время отклика не зависит от разрешения исходника. Прокси
+    уменьшены в степень двойки раз и не меньше, чем нужно для отображения. Полное разрешение вычисляется только при
+    вызове render без preview_size.
+
+    Исходным изображением может быть уменьшенная копия, полученная при быстром открытии файла (read_image_preview).
+    Тогда размер в полном разрешении передается в set_source, предпросмотр строится по копии, а вычисление в полном
+    разрешении недоступно до вызова set_source с полным изображением.
+
+        Attributes
+        ----------
+        self.max_cache_bytes : int
+            Максимальный суммарный размер результатов в кэше, в байтах
+        self.cache : OrderedDict
+            Кэш результатов шагов, упорядоченный от давно использованных к недавним
+        self.cache_bytes : int
+            Текущий размер результатов в кэше, в байтах
+        self.max_keyframe_bytes : int
+            Максимальный суммарный размер сжатых опорных кадров, в байтах
+        self.keyframe_interval : int
+            Результат какого по счету шага сохраняется как опорный кадр
+        self.keyframes : OrderedDict
+            Сжатые опорные кадры, упорядоченные от давно использованных к недавним
+        self.keyframe_bytes : int
+            Текущий размер опорных кадров, в байтах
+
+        Methods
+        -------
+        set_source(self, image, source_size=None)
+            Устанавливает исходное изображение или его уменьшенную копию и очищает кэш
+        has_full_source(self)
+            Проверяет, доступно ли исходное изображение в полном разрешении
+        source_size(self)
+            Возвращает размер исходного изображения
+        output_size(self, steps)
+            Вычисляет размер результата шагов в полном разрешении
+        render(self, steps, channel, preview_size=None, is_cancelled=None)
+            Применяет шаги и цветовой канал к исходному изображению или к его уменьшенной копии
+        clear(self)
+            Очищает кэш
+        """
+
+    def __init__(self, max_cache_bytes=DEFAULT_CACHE_BYTES, max_keyframe_bytes=DEFAULT_KEYFRAME_BYTES,
+                 keyframe_interval=DEFAULT_KEYFRAME_INTERVAL):
+        self.max_cache_bytes = max_cache_bytes
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.max_keyframe_bytes = max_keyframe_bytes
+        self.keyframe_interval = keyframe_interval
+        self.keyframes = OrderedDict()
+        self.keyframe_bytes = 0
+        self._source = None
+        self._source_size = (0, 0)
+        self._source_key = 0
+        # Наименьший доступный уровень прокси: больше 0, если исходник в полном разрешении еще не загружен
+        self._min_level = 0
+        # Уменьшенные копии исходного изображения: уровень k -> изображение, уменьшенное в 2 ** k раз
+        self._proxies = {}
+        # Буферы для смены цветового канала: уровень прокси -> массив, переиспользуемый между вызовами render
+        self._channel_buffers = {}
+
+    def set_source(self, image, source_size=None):
+        """Устанавливает исходное изображение, результаты для прошлого изображения удаляются из кэша
+
+        source_size: (ширина, высота) изображения в полном разрешении, если image - его копия, уменьшенная в степень
+        двойки раз при декодировании.
+        """
+        height, width = image.shape[:2]
+        if source_size is None or source_size == (width, height):
+            self._source = image
+            self._source_size = (width, height)
+            self._min_level = 0
+        else:
+            self._source = None
+            self._source_size = source_size
+            self._min_level = max(0, int(round(math.log2(source_size[0] / width))))
+        self._source_key += 1
+        self._proxies = {self._min_level: image}
+        self._channel_buffers = {}
+        self.clear()
+
+    def has_full_source(self):
+        """Проверяет, доступно ли исходное изображение в полном разрешении"""
+        return self._source is not None
+
+    def clear(self):
+        """Очищает кэш и опорные кадры"""
+        self.cache.clear()
+        self.cache_bytes = 0
+        self.keyframes.clear()
+        self.keyframe_bytes = 0
+
+    def source_size(self):
+        """Возвращает (ширину, высоту) исходного изображения в полном разрешении"""
+        return self._source_size
+
+    def output_size(self, steps):
+        """Вычисляет (ширину, высоту) результата шагов в полном разрешении"""
+        return output_size(steps, self.source_size())
+
+    def render(self, steps, channel, preview_size=None, is_cancelled=None):
+        """Применяет шаги к исходному изображению и оставляет выбранный цветовой канал
+
+        preview_size: (ширина, высота) области отображения. Если задан, шаги выполняются над прокси, а координаты
+        обрезки и прямоугольников переводятся в его масштаб. Иначе результат вычисляется в полном разрешении, если
+        оно еще не загружено, вызывается ValueError.
+
+        Находит последний шаг, результат которого есть в кэше, и выполняет только последующие шаги, сохраняя
+        результат. Прямоугольники рисуются на копии результата, а не на массиве из кэша. Возвращаемый массив нельзя
+        изменять: он может храниться в кэше, а при смене цветового канала или при наличии прямоугольников это
+        буфер, который перезаписывается следующим вызовом render с тем же масштабом.
+
+        is_cancelled - функция без аргументов, проверяется перед каждым шагом. Если она вернула True, вычисления
+        прекращаются и возвращается None, готовые результаты шагов остаются в кэше.
+        """
+        with stage("render", steps=len(steps), preview=preview_size is not None):
+            if preview_size is None:
+                if not self.has_full_source():
+                    raise ValueError("Изображение в полном разрешении еще не загружено")
+                level = 0
+            else:
+                level = max(self._min_level, self._preview_level(steps, preview_size))
+            if level:
+                scale = 0.5 ** level
+                steps = [scale_step(step, scale) for step in steps]
+            image = self._proxy(level)
+            height, width = image.shape[:2]
+            layer = AnnotationLayer.from_steps(steps, (width, height))
+            steps = [step for step in steps if step[0] != "draw"]
+
+            # Ключ результата - все шаги истории до него, а не объединенные шаги: новое действие не меняет ключи
+            # предыдущих. Шаги сравниваются целиком, а не по hash, поэтому разные истории не делят результат
+            source = ("source", self._source_key, level)
+            start = 0
+            for index in range(len(steps), 0, -1):
+                cached = self._restore((source, tuple(steps[:index])))
+                if cached is not None:
+                    image = cached
+                    start = index
+                    break
+
+            if start < len(steps):
+                # Объединяются только шаги после последнего сохраненного результата
+                height, width = image.shape[:2]
+                compiled = compile_steps(steps[start:], (width, height))
+                for index, (action, value) in enumerate(compiled):
+                    if is_cancelled is not None and is_cancelled():
+                        return None
+                    with stage(action, "action", index=start + index):
+                        image = OPERATIONS[action](image, value)
+                key = (source, tuple(steps))
+                self._store(key, image)
+                # Опорные кадры привязаны к позициям в истории, а не к объединенным шагам, которых обычно один
+                if self.keyframe_interval and len(steps) % self.keyframe_interval == 0:
+                    self._store_keyframe(key, image)
+
+            buffer = self._channel_buffers.get(level)
+            with stage("channel", channel=channel):
+                result = apply_channel(image, channel, buffer)
+            if len(layer):
+                with stage("annotations", segments=len(layer)):
+                    if result is image:
+                        if buffer is None or buffer.shape != image.shape or buffer.dtype != image.dtype:
+                            buffer = np.empty_like(image)
+                        np.copyto(buffer, image)
+                        result = buffer
+                    layer.draw(result, annotation_color(channel))
+            if result is not image:
+                self._channel_buffers[level] = result
+            return result
+
+    def _preview_level(self, steps, preview_size):
+        """Подбирает уровень прокси, достаточный для отображения результата в области preview_size
+
+        Масштаб отображения вычисляется по размеру результата в полном разрешении, так что после обрезки используется
+        более подробный прокси.
+        """
+        width, height = self.output_size(steps)
+        if width == 0 or height == 0:
+            return 0
+        scale = min(1.0, preview_size[0] / width, preview_size[1] / height)
+        level = int(math.floor(math.log2(1 / scale)))
+        source_width, source_height = self.source_size()
+        # Прокси не должен вырождаться в изображение меньше одного пикселя
+        while level > 0 and min(source_width, source_height) >> level == 0:
+            level -= 1
+        return level
+
+    def _proxy(self, level):
+        """Возвращает исходное изображение, уменьшенное в 2 ** level раз, создавая его при первом обращении
+
+        Прокси создается из наименьшего доступного уровня: исходника или уменьшенной при декодировании копии.
+        """
+        proxy = self._proxies.get(level)
+        if proxy is None:
+            width, height = self.source_size()
+            with stage("proxy", level=level):
+                proxy = cv2.resize(self._proxies[self._min_level], (max(1, width >> level), max(1, height >> level)),
+                                   interpolation=cv2.INTER_AREA)
+            self._proxies[level] = proxy
+        return proxy
+
+    def _restore(self, key):
+        """Возвращает результат шага из кэша или из опорного кадра, None, если результата нет"""
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.cache.move_to_end(key)
+            return cached
+        keyframe = self.keyframes.get(key)
+        if keyframe is None:
+            return None
+        self.keyframes.move_to_end(key)
+        data, shape, dtype = keyframe
+        with stage("keyframe_restore"):
+            image = np.frombuffer(zlib.decompress(data), dtype=dtype).reshape(shape)
+        self._store(key, image)
+        return image
+
+    def _store_keyframe(self, key, image):
+        """Сохраняет сжатый результат шага как опорный кадр, удаляя давно использованные при превышении памяти"""
+        if key in self.keyframes or image.nbytes == 0:
+            return
+        with stage("keyframe_store"):
+            data = zlib.compress(np.ascontiguousarray(image).data, 1)
+        if len(data) > self.max_keyframe_bytes:
+            return
+        self.keyframes[key] = (data, image.shape, image.dtype)
+        self.keyframe_bytes += len(data)
+        while self.keyframe_bytes > self.max_keyframe_bytes:
+            _, (evicted, _, _) = self.keyframes.popitem(last=False)
+            self.keyframe_bytes -= len(evicted)
+
+    def _store(self, key, image):
+        """Сохраняет результат шага в кэше и удаляет давно использованные результаты при превышении памяти"""
+        if image.nbytes > self.max_cache_bytes:
+            return
+        self.cache[key] = image
+        self.cache_bytes += image.nbytes
+        while self.cache_bytes > self.max_cache_bytes:
+            _, evicted = self.cache.popitem(last=False)
+            self.cache_bytes -= evicted.nbytes
+
+
+class Operation:
+    """Запись журнала действий: действие и его параметры
+
+        Attributes
+        ----------
+        action : str
+            Действие: "crop", "rotate" или "draw"
+        value : tuple or float
+            Параметры: координаты [y1, y2, x1, x2] для "crop" и "draw", угол поворота для "rotate"
+        """
+    __slots__ = ("action", "value")
+
+    def __init__(self, action, value):
+        if action not in OPERATION_CODES:
+            raise ValueError(f"Неизвестное действие: {action}")
+        try:
+            if action == "rotate":
+                parameters = float(value)
+                is_valid = math.isfinite(parameters)
+            else:
+                parameters = tuple(int(v) for v in value)
+                is_valid = len(parameters) == 4
+        except (TypeError, ValueError):
+            is_valid = False
+        if not is_valid:
+            raise ValueError(f"Неверные параметры действия {action}: {value!r}")
+        self.action = action
+        self.value = parameters
+
+    def __eq__(self, other):
+        return isinstance(other, Operation) and (self.action, self.value) == (other.action, other.value)
+
+    def __repr__(self):
+        return f"Operation({self.action!r}, {self.value!r})"
+
+
+class OperationLog:
+    """Упорядоченный журнал действий над изображением
+
+    Заменяет отдельные списки координат и углов и порядок действий: каждое действие хранится одной записью
+    Operation. Добавление выполняется за O(1), просмотр - по позиции без изменения журнала. Журнал сохраняется в
+    JSON или в компактный двоичный формат.
+
+        Attributes
+        ----------
+        self.operations : list
+            Записи Operation в порядке выполнения
+
+        Methods
+        -------
+        append(self, action, value)
+            Добавляет действие в конец журнала
+        replace_last(self, value)
+            Заменяет параметры последнего действия
+        last(self)
+            Возвращает последнее действие или None
+        iterate(self, position=0)
+            Перебирает действия, начиная с позиции position
+        to_list(self) / from_list(data)
+            Преобразует журнал в список для JSON и обратно
+        to_bytes(self) / from_bytes(data)
+            Преобразует журнал в двоичный формат и обратно
+        """
+    __slots__ = ("operations",)
+
+    def __init__(self, operations=None):
+        self.operations = list(operations) if operations is not None else []
+
+    def __len__(self):
+        return len(self.operations)
+
+    def __iter__(self):
+        return iter(self.operations)
+
+    def __eq__(self, other):
+        return isinstance(other, OperationLog) and self.operations == other.operations
+
+    def append(self, action, value):
+        """Добавляет действие в конец журнала"""
+        self.operations.append(Operation(action, value))
+
+    def replace_last(self, value):
+        """Заменяет параметры последнего действия, например итоговый угол нескольких поворотов подряд"""
+        last = self.operations[-1]
+        self.operations[-1] = Operation(last.action, value)
+
+    def last(self):
+        """Возвращает последнее действие или None, если журнал пуст"""
+        return self.operations[-1] if self.operations else None
+
+    def iterate(self, position=0):
+        """Перебирает действия, начиная с позиции position, без копирования журнала"""
+        for index in range(position, len(self.operations)):
+            yield self.operations[index]
+
+    def copy(self):
+        """Возвращает копию журнала, записи Operation не изменяются и используются совместно"""
+        return OperationLog(self.operations)
+
+    def to_list(self):
+        """Преобразует журнал в список [действие, параметры] для JSON"""
+        return [[operation.action, operation.value if operation.action == "rotate" else list(operation.value)]
+                for operation in self.operations]
+
+    @classmethod
+    def from_list(cls, data):
+        """Создает журнал из списка to_list"""
+        return cls(Operation(action, value) for action, value in data)
+
+    def to_bytes(self):
+        """Преобразует журнал в двоичный формат: число записей, затем код действия и параметры каждой записи"""
+        chunks = [OPERATION_COUNT_FORMAT.pack(len(self.operations))]
+        for operation in self.operations:
+            code = OPERATION_CODES[operation.action]
+            values = (operation.value,) if operation.action == "rotate" else operation.value
+            chunks.append(OPERATION_FORMATS[code].pack(code, *values))
+        return b"".join(chunks)
+
+    @classmethod
+    def from_bytes(cls, data, offset=0):
+        """Создает журнал из двоичного формата to_bytes, возвращает журнал и позицию после него"""
+        (count,) = OPERATION_COUNT_FORMAT.unpack_from(data, offset)
+        offset += OPERATION_COUNT_FORMAT.size
+        operations = []
+        for _ in range(count):
+            code = data[offset]
+            record_format = OPERATION_FORMATS[code]
+            _, *values = record_format.unpack_from(data, offset)
+            offset += record_format.size
+            action = OPERATION_ACTIONS[code]
+            operations.append(Operation(action, values[0] if action == "rotate" else values))
+        return cls(operations), offset
+
+
+class Image:
+    """Класс Image используется для хранения изображения, его свойств, и истории действий, совершенных над ним
+
+        Attributes
+        ----------
+        image : numpy.ndarray
+            Изображение - многомерный массив
+        color_channel : str
+            Названия цветового канала изображения: "Красный", "Синий", "Зеленый", "Без эффекта"
+        operations : OperationLog
+            Журнал действий над изображением в порядке выполнения
+        """
+
+    def __init__(
+            self,
+            image=None,
+            color_channel="Без эффекта",
+            operations=None):
+        if operations is None:
+            operations = OperationLog()
+        self.image = image
+        self.color_channel = color_channel
+        self.operations = operations
+
+    def set_color_channel(self, color_channel):
+        self.color_channel = color_channel
+
+    def set_operations(self, operations):
+        self.operations = operations
+
+    def get_color_channel(self):
+        return self.color_channel
+
+    def get_operations(self):
+        return self.operations
+
+    def get_image(self):
+        return self.image
+
+
+def decode_file(path, decode):
+    """Передает содержимое файла path в функцию decode в виде numpy.ndarray и возвращает ее результат
+
+    Файл отображается в память без копирования в bytes. Если отобразить файл нельзя (пустой файл, файловая система
+    без поддержки mmap), файл читается целиком, для пустого файла возвращается None.
+    """
+    # Для правильной обработки кириллицы файл открывается средствами Python, а не cv2.imread
+    with open(path, "rb") as file:
+        try:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            in_bytes = file.read()
+            if not in_bytes:
+                return None
+            return decode(np.frombuffer(in_bytes, dtype=np.uint8))
+    numpy_array = np.frombuffer(mapped, dtype=np.uint8)
+    # Отображение нельзя закрыть, пока на него ссылается массив. Если decode вызвал исключение, на массив ссылается
+    # трассировка исключения, поэтому отображение не закрывается явно, а освобождается вместе с ней
+    result = decode(numpy_array)
+    del numpy_array
+    mapped.close()
+    return result
+
+
+def read_image(path, flags=cv2.IMREAD_COLOR):
+    """Читает и декодирует изображение из файла, возвращает None, если файл не удалось декодировать
+
+    Файл отображается в память и передается в cv2.imdecode без копирования.
+    """
+    with stage("decode", path=os.path.basename(path)):
+        return decode_file(path, lambda data: cv2.imdecode(data, flags))
+
+
+def header_size(data):
+    """Читает (ширину, высоту) изображения из заголовка JPEG или PNG без декодирования
+
+    data - содержимое файла в виде numpy.ndarray. Для других форматов и поврежденных заголовков возвращает None.
+    """
+    data = memoryview(data)
+    if bytes(data[:8]) == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        return int.from_bytes(data[16:20], "big"), int.from_bytes(data[20:24], "big")
+    if bytes(data[:2]) != b"\xff\xd8":
+        return None
+    position = 2
+    while position + 9 <= len(data):
+        if data[position] != 0xFF:
+            return None
+        marker = data[position + 1]
+        if marker == 0xFF:
+            # Байты заполнения между маркерами
+            position += 1
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            height = int.from_bytes(data[position + 5:position + 7], "big")
+            width = int.from_bytes(data[position + 7:position + 9], "big")
+            return width, height
+        position += 2 + int.from_bytes(data[position + 2:position + 4], "big")
+    return None
+
+
+def reduction_for_preview(size, preview_size):
+    """Подбирает, во сколько раз (1, 2, 4 или 8) можно уменьшить изображение size для области preview_size"""
+    width, height = size
+    if width == 0 or height == 0:
+        return 1
+    scale = min(1.0, preview_size[0] / width, preview_size[1] / height)
+    for reduction in (8, 4, 2):
+        if reduction * scale <= 1:
+            return reduction
+    return 1
+
+
+def read_image_preview(path, preview_size):
+    """Быстро открывает изображение для отображения в области preview_size
+
+    Для JPEG размер читается из заголовка, и изображение декодируется сразу в уменьшенном в 2, 4 или 8 раз
+    разрешении (cv2.IMREAD_REDUCED_COLOR_*), которого достаточно для отображения. Если декодер повернул изображение
+    по ориентации из EXIF, ширина и высота из заголовка меняются местами. Полное разрешение нужно загрузить позже
+    через read_image. Возвращает изображение (или None, если файл не удалось декодировать) и
+    (ширину, высоту) в полном разрешении.
+    """
+    def decode(data):
+        size = header_size(data)
+        if size is None or bytes(data[:2]) != b"\xff\xd8":
+            image = cv2.imdecode(data, cv2.IMREAD_COLOR)
+            if image is None:
+                return None, None
+            return image, (image.shape[1], image.shape[0])
+        reduction = reduction_for_preview(size, preview_size)
+        image = cv2.imdecode(data, REDUCED_DECODE_FLAGS[reduction])
+        if image is None:
+            return None, None
+        # Заголовок SOF хранит размер до поворота по EXIF, а декодер поворачивает изображение
+        width, height = size
+        reduced_size = (-(-width // reduction), -(-height // reduction))
+        if (image.shape[1], image.shape[0]) != reduced_size and (image.shape[0], image.shape[1]) == reduced_size:
+            size = (height, width)
+        return image, size
+
+    with stage("decode_preview", path=os.path.basename(path)):
+        return decode_file(path, decode) or (None, None)
+
+
+def encode_params(path, preset=None, quality=None):
+    """Возвращает параметры cv2.imencode для формата по расширению path по пресету EXPORT_PRESETS
+
+    quality задает значение вместо пресета: степень сжатия для PNG, качество для JPEG и WebP. Без пресета и
+    quality, а также для форматов не из EXPORT_FORMATS возвращает пустой список: настройки OpenCV по умолчанию.
+    Вызывает ValueError для неизвестного пресета или quality вне допустимого диапазона формата.
+    """
+    if preset is not None and preset not in EXPORT_PRESETS:
+        raise ValueError(f"Неизвестный пресет экспорта: {preset}")
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in EXPORT_FORMATS or (preset is None and quality is None):
+        return []
+    flag, minimum, maximum = EXPORT_FORMATS[extension]
+    if quality is None:
+        compression, jpeg_quality, webp_quality = EXPORT_PRESETS[preset]
+        quality = {cv2.IMWRITE_PNG_COMPRESSION: compression, cv2.IMWRITE_JPEG_QUALITY: jpeg_quality,
+                   cv2.IMWRITE_WEBP_QUALITY: webp_quality}[flag]
+    if not minimum <= quality <= maximum:
+        raise ValueError(f"Значение {quality} вне допустимого диапазона {minimum}-{maximum} для формата {extension}")
+    return [flag, quality]
+
+
+def encode_image(path, image, params=None):
+    """Кодирует изображение в формат по расширению path, возвращает numpy.ndarray с байтами файла
+
+    params - параметры cv2.imencode (encode_params), по умолчанию настройки OpenCV.
+    """
+    with stage("encode", path=os.path.basename(path)):
+        is_encoded, buffer = cv2.imencode(os.path.splitext(path)[1], image, params or [])
+    if not is_encoded:
+        raise ValueError(f"Не удалось закодировать изображение: {path}")
+    return buffer
+
+
+def write_file(path, buffer):
+    """Записывает закодированное изображение buffer в файл path одной операцией, поддерживает кириллицу в пути
+
+    Буфер numpy.ndarray передается в write без копирования в bytes. Запись идет во временный файл рядом с path,
+    который затем атомарно переименовывается, поэтому при ошибке не остается недописанного файла.
+    """
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with stage("write", path=os.path.basename(path)), open(temp_path, "wb", buffering=0) as file:
+            view = memoryview(buffer).cast("B")
+            # Небуферизованная запись может записать только часть данных
+            while view:
+                view = view[file.write(view):]
+        os.replace(temp_path, path)
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_image(path, image, params=None):
+    """Кодирует изображение в формат по расширению path и записывает в файл, поддерживает кириллицу в пути"""
+    write_file(path, encode_image(path, image, params))
+
+
+def history_to_dict(image):
+    """Преобразует историю действий над изображением в словарь, пригодный для сохранения в JSON
+
+    Сохраняются аттрибуты Image - color_channel и журнал operations. Само изображение не сохраняется.
+    """
+    return {
+        "color_channel": image.get_color_channel(),
+        "operations": image.get_operations().to_list(),
+    }
+
+
+def _legacy_operations(data):
+    """Собирает журнал действий из прежнего формата: порядок действий и отдельные списки параметров"""
+    parameters = {
+        "crop": data.get("crop_coordinates", []),
+        "rotate": data.get("angel_rotation", []),
+        "draw": data.get("draw_coordinates", []),
+    }
+    positions = {"crop": 0, "rotate": 0, "draw": 0}
+    operations = OperationLog()
+    for action in data.get("actions", []):
+        values = parameters.get(action)
+        if values is None or positions[action] >= len(values):
+            continue
+        operations.append(action, values[positions[action]])
+        positions[action] += 1
+    return operations
+
+
+def history_from_dict(data, image=None):
+    """Создает объект Image для изображения image с историей действий из словаря history_to_dict
+
+    Поддерживается и прежний формат с порядком действий "actions" и отдельными списками параметров. При ошибке
+    формата вызывает ValueError.
+    """
+    try:
+        if "operations" in data:
+            operations = OperationLog.from_list(data["operations"])
+        else:
+            operations = _legacy_operations(data)
+        channel = data.get("color_channel", "Без эффекта")
+    except (AttributeError, IndexError, KeyError, TypeError) as error:
+        raise ValueError(f"Неверный формат истории действий: {error!r}") from error
+    if channel not in CHANNELS:
+        raise ValueError(f"Неизвестный цветовой канал: {channel}")
+    return Image(image, channel, operations)
+
+
+def history_to_bytes(image):
+    """Преобразует историю действий в компактный двоичный формат: заголовок, цветовой канал и журнал действий"""
+    channel = CHANNELS.index(image.get_color_channel())
+    return HISTORY_MAGIC + bytes([channel]) + image.get_operations().to_bytes()
+
+
+def history_from_bytes(data, image=None):
+    """Создает объект Image для изображения image с историей действий из двоичного формата history_to_bytes
+
+    При ошибке формата, например в обрезанном файле, вызывает ValueError.
+    """
+    if not data.startswith(HISTORY_MAGIC):
+        raise ValueError("Файл не является историей действий")
+    offset = len(HISTORY_MAGIC)
+    try:
+        channel = CHANNELS[data[offset]]
+        operations, _ = OperationLog.from_bytes(data, offset + 1)
+    except (IndexError, KeyError, struct.error) as error:
+        raise ValueError(f"Неверный формат истории действий: {error!r}") from error
+    return Image(image, channel, operations)
+
+
+def save_history(path, image):
+    """Сохраняет историю действий над изображением: в JSON для файлов .json, иначе в двоичном формате"""
+    if os.path.splitext(path)[1].lower() == ".json":
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(history_to_dict(image), file, ensure_ascii=False, indent=2)
+    else:
+        with open(path, "wb") as file:
+            file.write(history_to_bytes(image))
+
+
+def load_history(path):
+    """Загружает историю действий из файла save_history, возвращает объект Image без изображения
+
+    Формат определяется по заголовку файла. При ошибке формата вызывает ValueError.
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+    if data.startswith(HISTORY_MAGIC):
+        return history_from_bytes(data)
+    try:
+        data = json.loads(data.decode("utf-8"))
+    except ValueError as error:
+        # UnicodeDecodeError и json.JSONDecodeError
+        raise ValueError(f"Ошибка чтения истории действий: {error}") from error
+    return history_from_dict(data)
+
+
+def render_history(source, history, pipeline=None):
+    """Применяет историю действий к изображению source в полном разрешении
+
+    history: объект Image с цветовым каналом и журналом действий. Если pipeline не передан, создается EditPipeline
+    без кэша промежуточных результатов и опорных кадров.
+    """
+    if pipeline is None:
+        pipeline = EditPipeline(max_cache_bytes=0, max_keyframe_bytes=0)
+    pipeline.set_source(source)
+    steps = build_steps(history.get_operations())
+    return pipeline.render(steps, history.get_color_channel())
@@ -0,0 +1,1016 @@
+"""Окно фоторедактора
+
+OpenCV, numpy и модули редактирования импортируются не при загрузке модуля, а в фоновом потоке после появления
+окна (import_editing_modules) и в функциях, которые ими пользуются, поэтому окно показывается до их загрузки.
+"""
+import os
+import traceback
+from functools import partial
+
+from PyQt5.QtCore import Qt, QSize, QObject, QRunnable, QThreadPool, QTimer, pyqtSignal
+from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QPushButton, QLabel, QFileDialog, QHBoxLayout, \
+    QComboBox, QSpinBox, QMessageBox
+from PyQt5.QtGui import QPixmap, QImage
+
+from profiling import stage, tracer
+
+# Пресеты экспорта в списке выбора: название -> пресет image_editing.EXPORT_PRESETS, первый выбран по умолчанию
+EXPORT_PRESET_NAMES = {
+    "Сбалансированно": "balanced",
+    "Быстрое кодирование": "fast",
+    "Меньший размер файла": "small",
+    "Наилучшее качество": "best",
+}
+# Фильтры диалога экспорта: фильтр -> расширение файла, если пользователь его не указал
+EXPORT_FILTERS = {
+    "PNG (*.png)": ".png",
+    "JPEG (*.jpg *.jpeg)": ".jpg",
+    "WebP (*.webp)": ".webp",
+}
+
+
+class MainWindow(QWidget):
+    """Класс, создает окно для отображения фото, выбора функции, создания снимка с веб-камеры.
+
+    Функции: Вывод изображения на экран, снимок с веб-камеры, обрезка, поворот фото, рисование синего прямоугольника,
+    выбор цветового канала.
+        Attributes
+        ----------
+        self.selected_image : Image
+            Переменная, хранящая оригинал загруженного изображения. None до initialize_editing
+        self.displayed_image : numpy.ndarray
+            Изображение - многомерный массив, результат редактирования для области отображения. Обновляется при
+            редактировании изображения
+        self.image_size : tuple
+            Ширина и высота отредактированного изображения в полном разрешении
+        self.is_loaded : boolean
+            Загружено ли изображение
+        self.pipeline : EditPipeline
+            Применяет действия к изображению, хранит промежуточные результаты. None до загрузки изображения
+        self.thread_pool : QThreadPool
+            Пул потоков для фоновых задач, например загрузки изображения в полном разрешении
+        self.load_number : int
+            Номер последней загрузки изображения, результаты фоновой загрузки прошлых изображений игнорируются
+        self.image_cache : ImageCache
+            Кэш декодированных изображений: повторно открытый файл не декодируется. None до initialize_editing
+        self.capture_manager : CaptureManager
+            Подключение к веб-камере, открывается при первом снимке и остается открытым. None до
+            initialize_editing
+        self.preview_timer : QTimer
+            Таймер вывода кадров живого просмотра с веб-камеры
+        self.undo_stack : list
+            Состояния истории действий (цветовой канал и копия журнала действий) до каждого изменения, для отмены
+        self.redo_stack : list
+            Отмененные состояния истории действий, для повтора действий
+        self.render_number : int
+            Номер последнего запроса отрисовки, отрисовки с меньшим номером отменяются
+        self.is_rendering : boolean
+            Выполняется ли отрисовка в фоновом потоке
+        self.render_canvas : DisplayCanvas
+            Холст области отображения для результатов отрисовки в фоновом потоке. None до initialize_editing
+        self.preview_canvas : DisplayCanvas
+            Холст области отображения для кадров живого просмотра с веб-камеры. None до initialize_editing
+        self.editing_ready : pyqtSignal
+            Сигнал, который испускается, когда модули редактирования загружены и окно готово к работе
+        self.trace_mark : int
+            Метка замеров (profiling.tracer) на начало последней отрисовки, для вывода ее этапов под изображением
+        self.pending_exports : list
+            Экспорты, ожидающие загрузки изображения в полном разрешении: номер загрузки, путь, параметры
+            cv2.imencode и копия истории действий
+        self.export_count : int
+            Сколько экспортов выполняется в фоновых потоках
+
+        Methods
+        -------
+        __init__(self)
+            Инициализирует окно приложения, создает, настраивает
+            виджеты, создает необходимые переменные
+        initialize_editing(self)
+            Импортирует модули редактирования и создает объекты для работы с изображениями
+        add_function_panel(self)
+            После загрузки фото добавляет панель управления функциями
+        update_function_panel(self)
+            Обновляет панель управления функциями при изменении свойств изображения
+        load_image(self)
+            Загружает изображение и обновляет связанные переменные
+        finish_loading(self, load_number, loaded)
+            Заменяет уменьшенную копию изображением в полном разрешении, загруженным в фоне
+        start_task(self, function, *args, on_finished)
+            Выполняет функцию в пуле потоков и передает результат в поток интерфейса
+        capture_image(self)
+            Создает снимок, с веб-камеры или сообщает об ошибке, обновляет связанные переменные
+        toggle_live_preview(self)
+            Включает или выключает живой просмотр с веб-камеры
+        stop_live_preview(self)
+            Выключает живой просмотр с веб-камеры
+        show_preview_frame(self)
+            Выводит на экран следующий кадр живого просмотра
+        closeEvent(self, event)
+            Закрывает подключение к веб-камере при закрытии окна
+        display_image(self)
+            Обновляет панель управления и запрашивает отрисовку изображения согласно журналу действий
+        build_steps(self)
+            Собирает шаги редактирования для self.pipeline
+        start_render(self)
+            Запускает отрисовку изображения в фоновом потоке
+        finish_render(self, render_number, result)
+            Выводит результат отрисовки на экран
+        set_source(self, image, source_size=None)
+            Создает новый self.pipeline для исходного изображения
+        change_channel(self, channel):
+            Меняет цветовой канал изображения
+        crop_image(self)
+            Обрезает изображение по координатам
+        rotate_image(self)
+            Поворачивает изображение по значению угла
+        draw_blue_rectangle(self):
+        Рисует синий прямоугольник на изображении по координатам двух противоположных углов
+        save_history(self)
+            Сохраняет историю действий в JSON-файл для пакетной обработки
+        export(self)
+            Экспортирует результат в полном разрешении в PNG, JPEG или WebP с выбранным пресетом
+        start_export(self, image, file_path, params, history)
+            Запускает экспорт в фоновом потоке
+        finish_export(self, result)
+            Сообщает об ошибке экспорта
+        save_trace(self)
+            Сохраняет замеры этапов обработки в формате Chrome trace, если замеры включены
+        remember_state(self)
+            Запоминает состояние истории действий перед изменением
+        undo(self)
+            Отменяет последнее действие
+        redo(self)
+            Повторяет отмененное действие
+        cancel_changes(self)
+            Отменяет все действия, совершенные над изображением
+        """
+    editing_ready = pyqtSignal()
+
+    def __init__(self):
+        """Инициализирует окно приложения с местом для изображения и кнопками для загрузки и создания снимка
+
+        Создает необходимые виджеты, связывает их с соответствующими функциями, флаг self.is_loaded = False.
+        Модули редактирования загружаются в фоне после запуска цикла событий, а объекты для работы с
+        изображениями создаются в initialize_editing.
+        """
+        super().__init__()
+        self.selected_image = None
+        self.displayed_image = None
+        self.image_size = (0, 0)
+        self.is_loaded = False
+        # Флаг, определяет, как ведет себя смена цветового канала:
+        self.editing_is_complete = False
+        # False - идет отображение, сигналы виджетов игнорируются
+        # True - добавление новых изменений в атрибуты изображения Image
+        self.pipeline = None
+        self.thread_pool = QThreadPool()
+        self.load_number = 0
+        self.tasks = set()
+        self.undo_stack = []
+        self.redo_stack = []
+        self.render_number = 0
+        self.is_rendering = False
+        self.trace_mark = 0
+        self.pending_exports = []
+        self.export_count = 0
+        self.render_canvas = None
+        self.preview_canvas = None
+        self.image_cache = None
+        self.capture_manager = None
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setInterval(30)
+        self.preview_timer.timeout.connect(self.show_preview_frame)
+
+        self.setWindowTitle("Photo Editor")
+        self.setFixedSize(1030, 630)
+
+        desktop = QApplication.desktop()
+        x = (desktop.width() - self.width()) // 2
+        y = (desktop.height() - self.height()) // 2
+        self.move(x, y)  # Помещение окна в центре экрана
+
+        self.layout = QVBoxLayout()
+        self.image_layout = QHBoxLayout()
+        self.function_widget = QWidget()
+        self.function_widget.setFixedSize(400, 550)
+
+        self.functions_layout = QVBoxLayout()
+        self.function_widget.setLayout(self.functions_layout)
+        self.layout.addLayout(self.image_layout)
+
+        self.label_image = QLabel(self)
+        self.label_image.setFixedSize(QSize(1000, 500))
+        self.label_image.setStyleSheet("border: 2px solid gray;")
+        self.image_layout.addWidget(self.label_image, alignment=Qt.AlignCenter)
+        self.image_layout.addWidget(self.function_widget)
+
+        self.channel_combo_box = QComboBox()
+        self.channel_combo_box.addItems(
+            ["Без эффекта", "Красный", "Зеленый", "Синий"])
+        (self.channel_combo_box.currentIndexChanged.connect
+         (lambda index: self.change_channel(self.channel_combo_box.itemText(index))))
+
+        self.crop_label = QLabel(
+            "Введите координаты для обрезки изображения: ")
+        self.crop_button = QPushButton("Обрезать изображение")
+        self.crop_button.clicked.connect(self.crop_image)
+        self.crop_spin_boxes = []
+
+        self.label_rotation = QLabel("Введите угол поворота изображения:")
+        self.rotation_spin_box = QSpinBox()
+        self.rotation_spin_box.setMaximum(360)
+        self.rotation_spin_box.setMinimum(-360)
+
+        self.button_widget = QWidget()
+        self.button_layout = QVBoxLayout()
+        self.button_widget.setLayout(self.button_layout)
+
+        self.btn_load_image = QPushButton("Загрузить изображение", self)
+        self.btn_load_image.clicked.connect(self.load_image)
+        self.btn_load_image.setMinimumWidth(300)
+        self.button_layout.addWidget(
+            self.btn_load_image,
+            alignment=Qt.AlignCenter)
+        self.layout.addWidget(self.button_widget)
+
+        self.btn_capture_image = QPushButton(
+            "Сделать снимок с веб-камеры", self)
+        self.btn_capture_image.clicked.connect(self.capture_image)
+        self.btn_capture_image.setMinimumWidth(300)
+        self.button_layout.addWidget(
+            self.btn_capture_image,
+            alignment=Qt.AlignCenter)
+
+        self.btn_live_preview = QPushButton(
+            "Включить просмотр с веб-камеры", self)
+        self.btn_live_preview.clicked.connect(self.toggle_live_preview)
+        self.btn_live_preview.setMinimumWidth(300)
+        self.button_layout.addWidget(
+            self.btn_live_preview,
+            alignment=Qt.AlignCenter)
+
+        self.channel_btn = QLabel("Выберите цветовой канал: ")
+        self.size_label = QLabel()
+        self.rotate_button = QPushButton("Повернуть изображение")
+        self.rotate_button.clicked.connect(self.rotate_image)
+
+        self.draw_label = QLabel(
+            "Чтобы нарисовать синий прямоугольник,\nвыберете"
+            " координаты двух противоположных углов: ")
+        self.draw_spin_boxes = []
+        self.draw_blue_rectangle_button = QPushButton(
+            "Нарисовать прямоугольник")
+        self.draw_blue_rectangle_button.clicked.connect(
+            self.draw_blue_rectangle)
+
+        self.save_history_button = QPushButton("Сохранить историю действий")
+        self.save_history_button.clicked.connect(self.save_history)
+        self.save_trace_button = QPushButton("Сохранить трассировку")
+        self.save_trace_button.clicked.connect(self.save_trace)
+        self.export_preset_combo_box = QComboBox()
+        self.export_preset_combo_box.addItems(EXPORT_PRESET_NAMES)
+        self.export_button = QPushButton("Экспортировать изображение")
+        self.export_button.clicked.connect(self.export)
+
+        self.undo_button = QPushButton("Отменить действие")
+        self.undo_button.setShortcut("Ctrl+Z")
+        self.undo_button.clicked.connect(self.undo)
+        self.redo_button = QPushButton("Повторить действие")
+        self.redo_button.setShortcut("Ctrl+Y")
+        self.redo_button.clicked.connect(self.redo)
+
+        self.cancel_button = QPushButton("Отменить все изменения")
+        self.cancel_button.clicked.connect(self.cancel_changes)
+        self.layout.addLayout(self.button_layout)
+        self.setLayout(self.layout)
+
+        # Срабатывает, когда окно уже показано и запущен цикл событий
+        QTimer.singleShot(0, lambda: self.start_task(import_editing_modules, on_finished=self.initialize_editing))
+
+    def initialize_editing(self, _=None):
+        """Импортирует модули редактирования и создает объекты для работы с изображениями, если они еще не созданы
+
+        Вызывается после фоновой загрузки модулей, а также перед первым действием с изображением, если оно
+        случилось раньше: тогда модули импортируются сразу.
+        """
+        if self.image_cache is not None:
+            return
+        from camera import CaptureManager
+        from image_cache import ImageCache
+        from image_editing import Image
+
+        self.selected_image = Image()
+        self.render_canvas = DisplayCanvas()
+        self.preview_canvas = DisplayCanvas()
+        self.image_cache = ImageCache()
+        self.capture_manager = CaptureManager()
+        self.editing_ready.emit()
+
+    def add_function_panel(self):
+        """После загрузки фото добавляет панель управления функциями
+
+        Создает необходимые виджеты, добавляет существующие в function_layout, устанавливает крайние значения для
+        spinbox на основе высоты и ширины self.image_size
+        """
+        self.setFixedSize(1500, 650)
+        desktop = QApplication.desktop()
+        x = (desktop.width() - self.width()) // 2
+        y = (desktop.height() - self.height()) // 2
+        self.move(x, y)
+
+        width, height = self.image_size
+        self.functions_layout.addWidget(self.size_label)
+        # Под размером выводятся этапы последней отрисовки, если включены замеры
+        self.size_label.setWordWrap(tracer.enabled)
+        self.update_size_label()
+
+        self.functions_layout.addWidget(self.channel_btn)
+
+        self.functions_layout.addWidget(self.channel_combo_box)
+        self.functions_layout.addWidget(self.crop_label)
+        coordinates = ["X1", "Y1", "X2", "Y2"]
+
+        def create_spin_boxes():
+            hor_layout1 = QHBoxLayout()
+            hor_layout2 = QHBoxLayout()
+            spin_boxes = []
+            for i in coordinates:
+                label = QLabel(f'{i}: ')
+                spinbox = QSpinBox()
+                if coordinates.index(i) <= 1:
+                    hor_layout1.addWidget(label)
+                    hor_layout1.addWidget(spinbox)
+                else:
+                    hor_layout2.addWidget(label)
+                    hor_layout2.addWidget(spinbox)
+                if coordinates.index(i) % 2 == 0:
+                    spinbox.setMaximum(width)
+                else:
+                    spinbox.setMaximum(height)
+                spinbox.setMinimum(0)
+                spin_boxes.append(spinbox)
+
+            self.functions_layout.addLayout(hor_layout1)
+            self.functions_layout.addLayout(hor_layout2)
+            return spin_boxes
+
+        self.crop_spin_boxes = create_spin_boxes()
+
+        self.functions_layout.addWidget(self.crop_button)
+
+        self.functions_layout.addWidget(self.label_rotation)
+        self.functions_layout.addWidget(self.rotation_spin_box)
+        self.functions_layout.addWidget(self.rotate_button)
+
+        self.functions_layout.addWidget(self.draw_label)
+        self.draw_spin_boxes = create_spin_boxes()
+        self.functions_layout.addWidget(self.draw_blue_rectangle_button)
+        self.functions_layout.addWidget(self.save_history_button)
+        export_layout = QHBoxLayout()
+        export_layout.addWidget(self.export_preset_combo_box)
+        export_layout.addWidget(self.export_button)
+        self.functions_layout.addLayout(export_layout)
+        if tracer.enabled:
+            self.functions_layout.addWidget(self.save_trace_button)
+        undo_layout = QHBoxLayout()
+        undo_layout.addWidget(self.undo_button)
+        undo_layout.addWidget(self.redo_button)
+        self.functions_layout.addLayout(undo_layout)
+        self.functions_layout.addWidget(self.cancel_button)
+
+    def update_function_panel(self):
+        """Обновляет панель управления функциями
+
+        Обновляет крайние значения spinbox, на основе новых ширины и длины, сбрасывает некоторые виджеты
+        """
+        self.channel_combo_box.setCurrentText(
+            self.selected_image.get_color_channel())
+
+        width, height = self.image_size
+        self.update_size_label()
+
+        for i in self.crop_spin_boxes:
+            if self.crop_spin_boxes.index(i) % 2 == 0:
+                i.setMaximum(width)
+            else:
+                i.setMaximum(height)
+
+        for i in self.draw_spin_boxes:
+            if self.draw_spin_boxes.index(i) % 2 == 0:
+                i.setMaximum(width)
+            else:
+                i.setMaximum(height)
+
+    def load_image(self):
+        """Загружает изображение
+
+        Получает путь к изображению, преобразует изображение в многомерный массив, создает объект Image, при
+        возникновении ошибки отображает QMessageBox с сообщением. Добавляет или обновляет панель управления.
+        Большие JPEG сначала декодируются в уменьшенном разрешении, достаточном для отображения, а полное
+        разрешение загружается в фоне и подставляется в finish_loading. Уже открывавшееся изображение берется из
+        self.image_cache без декодирования. Хэш содержимого файла для кэша вычисляется в фоне.
+        """
+        self.initialize_editing()
+        from image_editing import Image, read_image_preview
+
+        file_dialog = QFileDialog()
+        file_dialog.setNameFilter("Images (*.png *.jpg)")
+        file_dialog.setViewMode(QFileDialog.Detail)
+        if file_dialog.exec_():
+            file_path = file_dialog.selectedFiles()[0]
+            try:
+                # Хэш файла вычисляется только в фоне, здесь изображение берется из кэша, если хэш уже известен
+                image = self.image_cache.cached_image(file_path, read_file=False)
+            except OSError:
+                image = None
+            is_cached = image is not None
+            if not is_cached:
+                image, source_size = read_image_preview(file_path, (1000, 500))
+            if image is not None:
+                self.load_number += 1
+                self.set_source(image, None if is_cached else source_size)
+                if self.pipeline.has_full_source():
+                    self.selected_image = Image(image, "Без эффекта", )
+                    if not is_cached:
+                        self.start_task(self.image_cache.store_file_image, file_path, image)
+                else:
+                    # Оригинал появится в Image после загрузки в фоне
+                    self.selected_image = Image(None, "Без эффекта", )
+                    self.start_task(self.image_cache.load_file, file_path,
+                                    on_finished=partial(self.finish_loading, self.load_number))
+                self.displayed_image = image
+                self.image_size = self.pipeline.source_size()
+                self.undo_stack = []
+                self.redo_stack = []
+                if not self.is_loaded:
+                    self.add_function_panel()
+                    self.is_loaded = True
+                else:
+                    self.update_function_panel()
+                self.display_image()
+            else:
+                error_box = QMessageBox()
+                error_box.setIcon(QMessageBox.Critical)
+                error_box.setText(
+                    "Ошибка загрузки изображения,\nпопробуйте выбрать другое изображение или"
+                    " поменять директорию")
+                error_box.setWindowTitle("Ошибка")
+                error_box.exec_()
+
+    def finish_loading(self, load_number, loaded):
+        """Заменяет уменьшенную копию изображением в полном разрешении, загруженным в фоне
+
+        loaded - результат ImageCache.load_file или None, если загрузка не удалась. Сначала запускает экспорты этого
+        изображения, ожидавшие загрузки, даже если с тех пор открыто другое изображение, если загрузка не удалась -
+        сообщает об их ошибке. Декодированное изображение сохраняется в кэш отдельной задачей, чтобы запись на диск
+        не задерживала экспорт и отображение. Если с начала загрузки было открыто другое изображение или загрузка не
+        удалась, больше ничего не делает.
+        """
+        key, image, is_cached = loaded if loaded is not None else (None, None, True)
+        exports = [export for export in self.pending_exports if export[0] == load_number]
+        self.pending_exports = [export for export in self.pending_exports if export[0] != load_number]
+        for _, file_path, params, history in exports:
+            if image is None:
+                self.finish_export(None)
+            else:
+                self.start_export(image, file_path, params, history)
+        if image is not None and not is_cached:
+            self.start_task(self.image_cache.store_image, key, image)
+        if load_number != self.load_number or image is None:
+            return
+        self.selected_image.image = image
+        self.set_source(image)
+        self.display_image()
+
+    def set_source(self, image, source_size=None):
+        """Создает новый self.pipeline для исходного изображения
+
+        Прошлый объект не изменяется, так как им может пользоваться отрисовка в фоновом потоке.
+        """
+        from image_editing import EditPipeline
+
+        self.pipeline = EditPipeline()
+        self.pipeline.set_source(image, source_size)
+
+    def start_task(self, function, *args, on_finished=None):
+        """Выполняет function(*args) в self.thread_pool, результат передается в on_finished в потоке интерфейса"""
+        task = Task(function, *args)
+        self.tasks.add(task)
+
+        def finished(result):
+            self.tasks.discard(task)
+            if on_finished is not None:
+                on_finished(result)
+
+        task.signals.finished.connect(finished)
+        self.thread_pool.start(task)
+
+    def capture_image(self):
+        """Создает снимок с веб-камеры.
+
+        Создает объект Image. Добавляет или обновляет панель управления. Проверят наличие подключенных к устройству
+        и включенных камер через self.capture_manager, который ищет камеру один раз и держит подключение открытым.
+        Отображает сообщение с инструкцией в случае отсутствия камер (первые 5 индексов) и сообщение об ошибке, если
+        не получает изображение от работающей камеры. Во время живого просмотра снимком становится последний кадр,
+        а живой просмотр выключается.
+        """
+        self.initialize_editing()
+        from image_editing import Image
+
+        if self.capture_manager.open():
+            frame = self.capture_manager.grab()
+            if self.preview_timer.isActive():
+                self.stop_live_preview()
+            if frame is not None:
+                self.load_number += 1
+                self.selected_image = Image(frame, "Без эффекта", )
+                self.displayed_image = self.selected_image.get_image()
+                self.set_source(self.displayed_image)
+                self.image_size = self.pipeline.source_size()
+                self.undo_stack = []
+                self.redo_stack = []
+                if not self.is_loaded:
+                    self.add_function_panel()
+                    self.is_loaded = True
+                else:
+                    self.update_function_panel()
+                self.display_image()
+            else:
+                error_box = QMessageBox()
+                error_box.setIcon(QMessageBox.Critical)
+                error_box.setText(
+                    "Невозможно сделать снимок. Проверьте исправность подключенных камер")
+                error_box.setWindowTitle("Ошибка")
+                error_box.exec_()
+        else:
+            error_box = QMessageBox()
+            error_box.setIcon(QMessageBox.Critical)
+            error_box.setText(
+                "Невозможно сделать снимок.\n Убедитесь, что к устройству подключена работающая камера\n"
+                "Перейдите: Диспетчер устройств >> Камеры\n"
+                " ---Если устройство отображается: правая кнопка мыши >> включить устройство\n"
+                " ---Иначе: Проверьте исправность подключения")
+            error_box.setWindowTitle("Ошибка")
+            error_box.exec_()
+
+    def toggle_live_preview(self):
+        """Включает или выключает живой просмотр с веб-камеры
+
+        Кадры читаются в фоновом потоке self.capture_manager, а self.preview_timer выводит их на экран. После
+        выключения на экран возвращается редактируемое изображение.
+        """
+        self.initialize_editing()
+        # Состояние кнопки определяет таймер: поток чтения кадров может остановиться сам, если камера отключилась
+        if self.preview_timer.isActive():
+            self.stop_live_preview()
+        elif self.capture_manager.start_preview():
+            self.btn_live_preview.setText("Выключить просмотр с веб-камеры")
+            self.preview_timer.start()
+        else:
+            error_box = QMessageBox()
+            error_box.setIcon(QMessageBox.Critical)
+            error_box.setText(
+                "Невозможно включить просмотр.\n Убедитесь, что к устройству подключена работающая камера")
+            error_box.setWindowTitle("Ошибка")
+            error_box.exec_()
+
+    def stop_live_preview(self):
+        """Выключает живой просмотр с веб-камеры и возвращает на экран редактируемое изображение"""
+        self.preview_timer.stop()
+        self.capture_manager.stop_preview()
+        self.btn_live_preview.setText("Включить просмотр с веб-камеры")
+        if self.is_loaded:
+            self.display_image()
+
+    def show_preview_frame(self):
+        """Выводит на экран следующий кадр живого просмотра, если он есть в буфере"""
+        if not self.capture_manager.is_previewing():
+            # Камера перестала отдавать кадры
+            self.stop_live_preview()
+            return
+        frame = self.capture_manager.next_frame()
+        if frame is not None:
+            height, width = frame.shape[:2]
+            self.label_image.setPixmap(QPixmap.fromImage(self.preview_canvas.draw(frame, (width, height))))
+
+    def closeEvent(self, event):
+        """Закрывает подключение к веб-камере при закрытии окна"""
+        self.preview_timer.stop()
+        if self.capture_manager is not None:
+            self.capture_manager.release()
+        super().closeEvent(event)
+
+    def display_image(self):
+        """Выводит изображение на экран
+
+        Запускается при каждом изменении изображения. Вычисляет размер изображения в полном разрешении без обработки
+        пикселей и обновляет панель управления, а само изображение отрисовывается в фоновом потоке (start_render).
+        Если отрисовка уже идет, она отменяется и после ее завершения запускается одна отрисовка последнего
+        состояния, поэтому несколько быстрых нажатий не создают очередь отрисовок.
+        """
+        self.editing_is_complete = False
+        self.image_size = self.pipeline.output_size(self.build_steps())
+        self.update_function_panel()
+        self.editing_is_complete = True
+
+        self.render_number += 1
+        if not self.is_rendering:
+            self.start_render()
+
+    def build_steps(self):
+        """Собирает шаги редактирования из журнала действий self.selected_image"""
+        from image_editing import build_steps
+
+        return build_steps(self.selected_image.get_operations())
+
+    def start_render(self):
+        """Запускает отрисовку текущего состояния изображения в self.thread_pool
+
+        Отрисовка прерывается между шагами, если за это время запрошена новая (self.render_number изменился).
+        """
+        render_number = self.render_number
+        self.is_rendering = True
+        self.trace_mark = tracer.mark()
+        self.start_task(render_preview, self.pipeline, self.build_steps(),
+                        self.selected_image.get_color_channel(), self.image_size, self.render_canvas,
+                        lambda: render_number != self.render_number,
+                        on_finished=partial(self.finish_render, render_number))
+
+    def finish_render(self, render_number, result):
+        """Выводит результат отрисовки в self.label_image или запускает отрисовку последнего состояния
+
+        result - изображение QImage холста self.render_canvas и результат шагов, или None, если отрисовка была
+        отменена или завершилась ошибкой. Следующая отрисовка начинается только после вывода холста, поэтому он не
+        меняется во время копирования в QPixmap.
+        """
+        self.is_rendering = False
+        if render_number != self.render_number:
+            self.start_render()
+        elif result is not None:
+            new_image, self.displayed_image = result
+            with stage("set_pixmap"):
+                self.label_image.setPixmap(QPixmap.fromImage(new_image))
+            if tracer.enabled:
+                self.update_size_label(tracer.summary(self.trace_mark))
+
+    def update_size_label(self, details=None):
+        """Выводит размер изображения в полном разрешении и, если передано, замеры этапов отрисовки details"""
+        width, height = self.image_size
+        text = f'Размер отображаемого изображения: {width}x{height}'
+        if details:
+            text += f'\n{details}'
+        self.size_label.setText(text)
+
+    def change_channel(self, channel):
+        """Меняет цветовой канал
+
+        Если нажата соответствующая кнопка: обновляет аттрибут Image - self.color_channel. Во время обновления
+        панели управления вызов игнорируется.
+        """
+        if self.editing_is_complete:
+            self.remember_state()
+            self.selected_image.set_color_channel(channel)
+            self.display_image()
+
+    def crop_image(self):
+        """Обрезает изображение по координатам
+
+        Добавляет действие "crop" в журнал действий self.selected_image
+        """
+        x1, y1, x2, y2 = [sb.value() for sb in self.crop_spin_boxes]
+        if x2 <= x1 or y2 <= y1:
+            error_box = QMessageBox()
+            error_box.setIcon(QMessageBox.Critical)
+            error_box.setText(
+                "Вторые координаты должны быть больше первых")
+            error_box.setWindowTitle("Ошибка")
+            error_box.exec_()
+            return
+        self.remember_state()
+        self.selected_image.get_operations().append("crop", (y1, y2, x1, x2))
+        self.display_image()
+
+    def rotate_image(self):
+        """Поворачивает изображение по значению угла
+
+        Добавляет действие "rotate" в журнал действий self.selected_image,
+        если пользователь несколько раз подряд поворачивает изображения, получается итоговый угол поворота
+        """
+        self.remember_state()
+        operations = self.selected_image.get_operations()
+        last = operations.last()
+        if last is not None and last.action == "rotate":
+            operations.replace_last(self.rotation_spin_box.value() + last.value)
+        else:
+            operations.append("rotate", self.rotation_spin_box.value())
+        self.display_image()
+
+    def draw_blue_rectangle(self):
+        """Рисует синий прямоугольник на изображении по координатам двух противоположных углов
+
+        Добавляет действие "draw" в журнал действий self.selected_image. Прямоугольник рисуется поверх результата
+        из кэша EditPipeline, изображение при этом не пересчитывается
+        """
+        x1, y1, x2, y2 = [sb.value() for sb in self.draw_spin_boxes]
+        self.remember_state()
+        self.selected_image.get_operations().append("draw", (y1, y2, x1, x2))
+        self.display_image()
+
+    def save_history(self):
+        """Сохраняет историю действий в файл
+
+        Сохраняются цветовой канал и журнал действий self.selected_image: в JSON для файлов .json, иначе в
+        компактном двоичном формате. Файл используется для применения тех же действий к другим изображениям:
+        python photo_editor.py batch --history <файл> ...
+        """
+        file_path, _ = QFileDialog.getSaveFileName(self, "Сохранить историю действий", "history.json",
+                                                   "История действий (*.json);;"
+                                                   "История действий, двоичный формат (*.hist)")
+        if not file_path:
+            return
+        from image_editing import save_history
+
+        try:
+            save_history(file_path, self.selected_image)
+        except OSError:
+            error_box = QMessageBox()
+            error_box.setIcon(QMessageBox.Critical)
+            error_box.setText(
+                "Ошибка сохранения истории действий,\nпопробуйте поменять директорию")
+            error_box.setWindowTitle("Ошибка")
+            error_box.exec_()
+
+    def export(self):
+        """Экспортирует результат истории действий в полном разрешении в PNG, JPEG или WebP
+
+        Формат определяется расширением файла или выбранным фильтром, качество - пресетом из
+        self.export_preset_combo_box. Отрисовка и кодирование выполняются в фоновом потоке отдельным EditPipeline,
+        поэтому можно продолжать редактирование и запускать несколько экспортов одновременно: OpenCV отпускает GIL,
+        и они кодируются параллельно. Если изображение в полном разрешении еще загружается, экспорт начнется
+        после загрузки.
+        """
+        file_path, selected_filter = QFileDialog.getSaveFileName(self, "Экспортировать изображение", "result.png",
+                                                                 ";;".join(EXPORT_FILTERS))
+        if not file_path:
+            return
+        from image_editing import EXPORT_FORMATS, Image, encode_params
+
+        if os.path.splitext(file_path)[1].lower() not in EXPORT_FORMATS:
+            file_path += EXPORT_FILTERS.get(selected_filter, ".png")
+        params = encode_params(file_path, EXPORT_PRESET_NAMES[self.export_preset_combo_box.currentText()])
+        # История действий может измениться до окончания экспорта, поэтому экспортируется ее копия
+        history = Image(None, *self.current_state())
+        self.export_count += 1
+        self.export_button.setText(f"Экспортировать изображение (выполняется: {self.export_count})")
+        if self.pipeline.has_full_source():
+            self.start_export(self.selected_image.get_image(), file_path, params, history)
+        else:
+            self.pending_exports.append((self.load_number, file_path, params, history))
+
+    def start_export(self, image, file_path, params, history):
+        """Запускает экспорт результата истории действий history над изображением image в файл file_path"""
+        self.start_task(export_image, image, history, file_path, params, on_finished=self.finish_export)
+
+    def finish_export(self, result):
+        """Уменьшает число выполняемых экспортов, при ошибке экспорта (result равен None) сообщает о ней"""
+        self.export_count -= 1
+        if self.export_count:
+            self.export_button.setText(f"Экспортировать изображение (выполняется: {self.export_count})")
+        else:
+            self.export_button.setText("Экспортировать изображение")
+        if result is None:
+            error_box = QMessageBox()
+            error_box.setIcon(QMessageBox.Critical)
+            error_box.setText(
+                "Ошибка экспорта изображения,\nпопробуйте поменять директорию или формат")
+            error_box.setWindowTitle("Ошибка")
+            error_box.exec_()
+
+    def save_trace(self):
+        """Сохраняет замеры этапов обработки в JSON-файл в формате Chrome trace (chrome://tracing, Perfetto)"""
+        file_path, _ = QFileDialog.getSaveFileName(self, "Сохранить трассировку", "trace.json",
+                                                   "Chrome trace (*.json)")
+        if not file_path:
+            return
+        try:
+            tracer.export(file_path)
+        except OSError:
+            error_box = QMessageBox()
+            error_box.setIcon(QMessageBox.Critical)
+            error_box.setText(
+                "Ошибка сохранения трассировки,\nпопробуйте поменять директорию")
+            error_box.setWindowTitle("Ошибка")
+            error_box.exec_()
+
+    def remember_state(self):
+        """Запоминает состояние истории действий перед изменением и очищает стек повтора
+
+        Сохраняются только параметры действий, а не изображения: промежуточные результаты при отмене берутся из
+        кэша и опорных кадров self.pipeline.
+        """
+        self.undo_stack.append(self.current_state())
+        self.redo_stack.clear()
+
+    def undo(self):
+        """Отменяет последнее действие, возвращая историю действий к состоянию до него"""
+        if self.undo_stack:
+            self.redo_stack.append(self.current_state())
+            self.restore_state(self.undo_stack.pop())
+
+    def redo(self):
+        """Повторяет последнее отмененное действие"""
+        if self.redo_stack:
+            self.undo_stack.append(self.current_state())
+            self.restore_state(self.redo_stack.pop())
+
+    def current_state(self):
+        """Возвращает состояние истории действий: цветовой канал и копию журнала действий
+
+        Записи журнала не изменяются, поэтому копируется только список ссылок на них.
+        """
+        return self.selected_image.get_color_channel(), self.selected_image.get_operations().copy()
+
+    def restore_state(self, state):
+        """Восстанавливает историю действий из состояния current_state и выводит изображение на экран"""
+        from image_editing import Image
+
+        color_channel, operations = state
+        self.selected_image = Image(self.selected_image.get_image(), color_channel, operations.copy())
+        self.display_image()
+
+    def cancel_changes(self):
+        """Отменяет все действия, совершенные над изображением
+
+        Сбрасывает журнал действий, обновляет self.displayed_image на изначальное изображение,
+        создает новый объект Image. Исходное изображение в self.pipeline не меняется. Отмену всех изменений тоже
+        можно отменить через undo.
+        """
+        from image_editing import Image
+
+        self.remember_state()
+        self.displayed_image = self.selected_image.get_image()
+        self.selected_image = Image(self.displayed_image)
+        self.display_image()
+
+
+def import_editing_modules():
+    """Импортирует OpenCV, numpy и модули редактирования, выполняется в фоновом потоке после появления окна
+
+    Это основная часть времени запуска. Повторный импорт в потоке интерфейса берет уже загруженные модули.
+    """
+    import camera
+    import image_cache
+    import image_editing
+    return camera, image_cache, image_editing
+
+
+def export_image(image, history, file_path, params):
+    """Применяет историю действий history к изображению image в полном разрешении и записывает результат в файл
+
+    Выполняется в фоновом потоке. params - параметры cv2.imencode (image_editing.encode_params). Возвращает путь
+    к файлу.
+    """
+    from image_editing import render_history, write_image
+
+    with stage("export"):
+        write_image(file_path, render_history(image, history), params)
+    return file_path
+
+
+def render_preview(pipeline, steps, channel, image_size, canvas, is_cancelled):
+    """Отрисовывает изображение для области отображения 1000x500, выполняется в фоновом потоке
+
+    Получает результат шагов из pipeline и выводит его на canvas (DisplayCanvas). image_size - размер результата в
+    полном разрешении. Возвращает QImage холста и результат шагов или None, если is_cancelled() вернула True.
+    """
+    with stage("display_image"):
+        displayed_image = pipeline.render(steps, channel, preview_size=(1000, 500), is_cancelled=is_cancelled)
+        if displayed_image is None:
+            return None
+        return canvas.draw(displayed_image, image_size), displayed_image
+
+
+def preview_area(size, image_size, area_size=(1000, 500)):
+    """Вычисляет размер изображения size в области отображения area_size
+
+    image_size - размер изображения в полном разрешении, size может быть размером его уменьшенной копии. Если
+    изображение в полном разрешении помещается в область, оно не масштабируется. Для пустого изображения
+    возвращает (0, 0).
+    """
+    width, height = size
+    if width == 0 or height == 0:
+        return 0, 0
+    area_width, area_height = area_size
+    # Масштаб выбирается по размеру в полном разрешении, прокси может быть меньше области отображения
+    full_width, full_height = image_size
+    if full_height < area_height and full_width < area_width:
+        return width, height
+    scaled_width = area_width
+    scaled_height = int(height * area_width / width)
+    if scaled_height > area_height:
+        scaled_width = int(scaled_width * area_height / scaled_height)
+        scaled_height = area_height
+    return scaled_width, scaled_height
+
+
+class DisplayCanvas:
+    """Постоянный холст области отображения: белый фон и изображение по центру
+
+    Буфер в RGB создается один раз, QImage ссылается на него без копирования. Изображение масштабируется сразу в
+    свою часть буфера, и в ней же переставляются каналы BGR в RGB, поэтому при обновлении не создаются
+    промежуточные изображения. Белым заново закрашивается только та часть прошлого изображения, которую не
+    закрывает новое.
+
+        Attributes
+        ----------
+        self.buffer : numpy.ndarray
+            Пиксели холста в RGB
+        self.image : QImage
+            Изображение, ссылающееся на self.buffer. Содержимое меняется при следующем вызове draw
+
+        Methods
+        -------
+        draw(self, image, image_size)
+            Выводит изображение BGR на холст, возвращает self.image
+        """
+
+    def __init__(self, width=1000, height=500):
+        import numpy as np
+
+        self.buffer = np.full((height, width, 3), 255, dtype=np.uint8)
+        self.image = QImage(self.buffer.data, width, height, 3 * width, QImage.Format_RGB888)
+        self._area = (0, 0, 0, 0)
+
+    def draw(self, image, image_size):
+        """Выводит изображение BGR на холст по центру, возвращает self.image
+
+        image_size - размер изображения в полном разрешении, image может быть его уменьшенной копией.
+        """
+        import cv2
+
+        area_height, area_width = self.buffer.shape[:2]
+        height, width = image.shape[:2]
+        scaled_width, scaled_height = preview_area((width, height), image_size, (area_width, area_height))
+        x = (area_width - scaled_width) // 2
+        y = (area_height - scaled_height) // 2
+        area = (x, y, scaled_width, scaled_height)
+        if area != self._area:
+            old_x, old_y, old_width, old_height = self._area
+            self.buffer[old_y:old_y + old_height, old_x:old_x + old_width] = 255
+            self._area = area
+        if scaled_width == 0 or scaled_height == 0:
+            return self.image
+
+        region = self.buffer[y:y + scaled_height, x:x + scaled_width]
+        if (scaled_width, scaled_height) == (width, height):
+            with stage("bgr_to_rgb"):
+                cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=region)
+        else:
+            with stage("resize"):
+                cv2.resize(image, (scaled_width, scaled_height), dst=region)
+            with stage("bgr_to_rgb"):
+                cv2.cvtColor(region, cv2.COLOR_BGR2RGB, dst=region)
+        return self.image
+
+
+class TaskSignals(QObject):
+    """Сигналы задачи Task. finished передает результат задачи в поток интерфейса"""
+    finished = pyqtSignal(object)
+
+
+class Task(QRunnable):
+    """Задача для QThreadPool: выполняет функцию в фоновом потоке и передает результат сигналом
+
+        Attributes
+        ----------
+        self.function : callable
+            Функция, выполняемая в фоновом потоке
+        self.args : tuple
+            Аргументы функции
+        self.signals : TaskSignals
+            Сигналы задачи. При любой ошибке результат равен None, непредвиденные ошибки выводятся в stderr
+        """
+
+    def __init__(self, function, *args):
+        super().__init__()
+        self.function = function
+        self.args = args
+        self.signals = TaskSignals()
+
+    def run(self):
+        import cv2
+
+        try:
+            result = self.function(*self.args)
+        except (OSError, ValueError, cv2.error):
+            result = None
+        except Exception:
+            # Исключение из QRunnable.run аварийно завершает приложение, а без сигнала finished окно ждало бы
+            # результат бесконечно
+            traceback.print_exc()
+            result = None
+        try:
+            self.signals.finished.emit(result)
+        except RuntimeError:
+            # Окно закрыто, пока задача выполнялась, результат больше не нужен
+            pass
@@ -0,0 +1,215 @@
+"""Замеры времени и памяти этапов обработки изображения
+
+Включается переменной окружения PHOTO_EDITOR_TRACE: значение "1" включает замеры, любое другое значение
+считается путем к JSON-файлу, в который трассировка записывается при завершении программы. Этапы (декодирование,
+каждый шаг истории действий, смена канала, масштабирование, подготовка QImage) размечаются контекстным менеджером
+stage. Для каждого этапа запоминаются длительность, выделенная и пиковая память, трассировка сохраняется в формате
+Chrome trace (chrome://tracing, Perfetto). Когда замеры выключены, stage ничего не делает.
+
+Память считается через tracemalloc: учитываются массивы numpy, в том числе результаты функций OpenCV, но не
+внутренние временные буферы OpenCV. Пиковая память общая для процесса, при одновременной работе нескольких потоков
+она включает и память других потоков. В Python до 3.9 пик tracemalloc нельзя сбросить, тогда пиком этапа
+считается наибольшая память в начале и конце его самого и вложенных этапов.
+"""
+import atexit
+import contextlib
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+# Переменная окружения, включающая замеры
+TRACE_VARIABLE = "PHOTO_EDITOR_TRACE"
+# Сколько последних этапов хранится, более старые отбрасываются
+MAX_EVENTS = 100000
+
+# Контекстный менеджер выключенных замеров
+_NULL_STAGE = contextlib.nullcontext()
+# Можно ли сбросить пик tracemalloc, tracemalloc.reset_peak появился в Python 3.9
+_CAN_RESET_PEAK = hasattr(tracemalloc, "reset_peak")
+
+
+class _Stage:
+    """Замер одного этапа, создается Tracer.stage"""
+    __slots__ = ("tracer", "name", "category", "args", "start", "memory_start", "peak")
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = 0
+        self.memory_start = 0
+        self.peak = 0
+
+    def __enter__(self):
+        if self.tracer.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if not _CAN_RESET_PEAK:
+                peak = current
+            stack = self.tracer._stack()
+            if stack:
+                # Пик внешнего этапа до начала вложенного, дальше пик считается заново
+                stack[-1].peak = max(stack[-1].peak, peak)
+            self.memory_start = current
+            self.peak = current
+            if _CAN_RESET_PEAK:
+                tracemalloc.reset_peak()
+            stack.append(self)
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter_ns()
+        args = self.args
+        if self.tracer.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            self.peak = max(self.peak, peak if _CAN_RESET_PEAK else current)
+            stack = self.tracer._stack()
+            stack.pop()
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, self.peak)
+            args = dict(args, allocated_bytes=current - self.memory_start, peak_bytes=self.peak - self.memory_start)
+        self.tracer._record(self.name, self.category, self.start, end - self.start, args)
+        return False
+
+
+class Tracer:
+    """Хранит замеры этапов обработки и сохраняет их в формате Chrome trace
+
+        Attributes
+        ----------
+        self.enabled : bool
+            Включены ли замеры
+        self.trace_memory : bool
+            Замеряется ли память этапов через tracemalloc
+        self.events : deque
+            Последние замеры: название, категория, начало и длительность в наносекундах, поток, параметры
+
+        Methods
+        -------
+        stage(self, name, category="stage", **args)
+            Возвращает контекстный менеджер, замеряющий этап name
+        mark(self)
+            Возвращает метку, с которой summary выводит замеры
+        summary(self, mark)
+            Возвращает строку с длительностью и памятью этапов после метки mark
+        to_chrome_trace(self)
+            Возвращает замеры в формате Chrome trace
+        export(self, path)
+            Записывает замеры в JSON-файл в формате Chrome trace
+        """
+
+    def __init__(self, enabled=False, trace_memory=True, max_events=MAX_EVENTS):
+        self.enabled = enabled
+        self.trace_memory = enabled and trace_memory
+        self.events = deque(maxlen=max_events)
+        self._count = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._thread_names = {}
+        self._origin = time.perf_counter_ns()
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stage(self, name, category="stage", **args):
+        """Возвращает контекстный менеджер, замеряющий этап name, args сохраняются вместе с замером"""
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name, category, args)
+
+    def mark(self):
+        """Возвращает метку: число замеров на текущий момент"""
+        with self._lock:
+            return self._count
+
+    def events_since(self, mark):
+        """Возвращает замеры, завершившиеся после метки mark, из тех, что еще хранятся"""
+        with self._lock:
+            count = min(self._count - mark, len(self.events))
+            return list(self.events)[len(self.events) - count:] if count > 0 else []
+
+    def summary(self, mark):
+        """Возвращает строку с суммарной длительностью и выделенной памятью этапов после метки mark
+
+        Этапы перечисляются в порядке начала, одноименные этапы складываются.
+        """
+        totals = {}
+        for name, _, start, duration, _, args in sorted(self.events_since(mark), key=lambda event: event[2]):
+            total = totals.setdefault(name, [0, 0, 0])
+            total[0] += duration
+            total[1] += args.get("allocated_bytes", 0)
+            total[2] += 1
+        parts = []
+        for name, (duration, allocated, count) in totals.items():
+            part = f"{name} {duration / 1e6:.1f} мс"
+            if count > 1:
+                part += f" ({count})"
+            if self.trace_memory:
+                part += f", {allocated / 2 ** 20:+.1f} МБ"
+            parts.append(part)
+        return "; ".join(parts)
+
+    def to_chrome_trace(self):
+        """Возвращает замеры в формате Chrome trace: события "X" с длительностью и названия потоков"""
+        process_id = os.getpid()
+        with self._lock:
+            events = list(self.events)
+            thread_names = dict(self._thread_names)
+        trace_events = [
+            {"name": "thread_name", "ph": "M", "pid": process_id, "tid": thread_id, "args": {"name": name}}
+            for thread_id, name in thread_names.items()
+        ]
+        for name, category, start, duration, thread_id, args in events:
+            trace_events.append({
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (start - self._origin) / 1000,
+                "dur": duration / 1000,
+                "pid": process_id,
+                "tid": thread_id,
+                "args": args,
+            })
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def export(self, path):
+        """Записывает замеры в JSON-файл path в формате Chrome trace"""
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.to_chrome_trace(), file, ensure_ascii=False)
+
+    def _stack(self):
+        """Возвращает стек открытых этапов текущего потока"""
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _record(self, name, category, start, duration, args):
+        """Сохраняет замер этапа"""
+        thread = threading.current_thread()
+        with self._lock:
+            self._thread_names[thread.ident] = thread.name
+            self.events.append((name, category, start, duration, thread.ident, args))
+            self._count += 1
+
+
+def _create_tracer():
+    """Создает Tracer по переменной окружения TRACE_VARIABLE и при необходимости записывает его при выходе"""
+    value = os.environ.get(TRACE_VARIABLE, "")
+    if value.lower() in ("", "0", "false", "no"):
+        return Tracer()
+    tracer = Tracer(enabled=True)
+    if value.lower() not in ("1", "true", "yes"):
+        atexit.register(tracer.export, value)
+    return tracer
+
+
+tracer = _create_tracer()
+
+
+def stage(name, category="stage", **args):
+    """Возвращает контекстный менеджер, замеряющий этап name в общем Tracer, если замеры включены"""
+    return tracer.stage(name, category, **args)
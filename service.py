@@ -0,0 +1,479 @@
+"""Локальный HTTP-сервис редактирования изображений
+
+Позволяет другим программам обрезать, поворачивать изображения, менять цветовой канал и рисовать прямоугольники
+без графического интерфейса. Запрос POST /render содержит закодированное изображение в теле и историю действий
+(словарь history_to_dict) в заголовке X-History, ответ - результат в формате из параметра format:
+    curl --data-binary @photo.jpg -H "X-History: $(cat history.json)" \\
+        "http://127.0.0.1:8765/render?format=png" -o result.png
+GET /metrics возвращает счетчики запросов, загрузку пула и задержки в JSON, GET /health - "ok".
+
+Сервис слушает только 127.0.0.1. Соединения обслуживаются в цикле событий asyncio, а декодирование, редактирование
+и кодирование выполняются в пуле процессов, так что цикл событий не блокируется. Одновременно в пул передается не
+больше запросов, чем в нем процессов, остальные ждут в очереди. Размер очереди ограничен: если она заполнена, запрос
+сразу получает ответ 503 с заголовком Retry-After, не читая тело, поэтому память сервиса не растет под нагрузкой.
+Модуль не импортирует PyQt5 и работает без дисплея.
+"""
+import asyncio
+import json
+import os
+import signal
+import sys
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import parse_qs, urlsplit
+
+import cv2
+import numpy as np
+
+from image_editing import EditPipeline, encode_image, history_from_dict, history_to_dict, render_history
+
+# Адрес, на котором слушает сервис: только локальные соединения
+HOST = "127.0.0.1"
+# Порт по умолчанию
+DEFAULT_PORT = 8765
+# Во сколько раз число запросов в очереди и в обработке может превышать число процессов
+QUEUE_PER_WORKER = 4
+# Ограничение размера тела запроса по умолчанию, в байтах
+DEFAULT_MAX_BODY_BYTES = 100 * 1024 * 1024
+# Ограничение размера строки запроса и заголовков, в байтах
+MAX_HEADER_BYTES = 64 * 1024
+# Сколько секунд ждать заголовков и тела запроса от клиента
+READ_TIMEOUT = 30
+# Размер части, которыми читается и отбрасывается тело отклоненного запроса, в байтах
+DISCARD_CHUNK_BYTES = 1024 * 1024
+# Через сколько секунд клиенту стоит повторить отклоненный запрос
+RETRY_AFTER = 1
+# По скольким последним запросам считаются задержки в метриках
+LATENCY_WINDOW = 1000
+# Форматы результата: значение параметра format -> расширение для cv2.imencode и тип содержимого
+OUTPUT_FORMATS = {
+    "png": (".png", "image/png"),
+    "jpg": (".jpg", "image/jpeg"),
+    "jpeg": (".jpg", "image/jpeg"),
+    "webp": (".webp", "image/webp"),
+}
+# Формат результата по умолчанию
+DEFAULT_FORMAT = "png"
+# Текст статусов HTTP, которые возвращает сервис
+STATUS_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    411: "Length Required",
+    413: "Payload Too Large",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+# EditPipeline процесса пула, создается один раз на процесс
+_worker_pipeline = None
+
+
+class RequestError(Exception):
+    """Ошибка запроса, которая возвращается клиенту с кодом status
+
+    body_read - прочитано ли тело запроса. Если нет, перед ответом тело отбрасывается, чтобы из соединения можно было
+    читать следующий запрос. headers - дополнительные заголовки ответа.
+    """
+
+    def __init__(self, status, message, body_read=False, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.body_read = body_read
+        self.headers = headers or {}
+
+
+def _init_worker():
+    """Подготавливает процесс пула: создает EditPipeline без кэша один раз на процесс"""
+    global _worker_pipeline
+    # Каждый процесс обрабатывает свой запрос, внутренние потоки OpenCV только конкурировали бы за ядра
+    cv2.setNumThreads(1)
+    _worker_pipeline = EditPipeline(max_cache_bytes=0, max_keyframe_bytes=0)
+
+
+def render_request(data, history_data, extension, pipeline=None):
+    """Декодирует изображение, применяет историю действий и кодирует результат, выполняется в процессе пула
+
+    data - содержимое файла изображения, history_data - словарь history_to_dict, extension - расширение формата
+    результата для cv2.imencode. Возвращает bytes закодированного результата. Если изображение не удалось
+    декодировать, вызывает ValueError.
+    """
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Не удалось декодировать изображение")
+    result = render_history(image, history_from_dict(history_data), pipeline or _worker_pipeline)
+    return encode_image(f"result{extension}", result).tobytes()
+
+
+def parse_history(value):
+    """Разбирает историю действий в JSON из заголовка X-History, возвращает нормализованный словарь history_to_dict
+
+    При ошибке формата вызывает RequestError с кодом 400.
+    """
+    if not value:
+        raise RequestError(400, "Не передана история действий (заголовок X-History)")
+    try:
+        # Заголовки читаются как latin-1, а файл истории действий может содержать названия каналов в UTF-8
+        history = history_from_dict(json.loads(value.encode("latin-1").decode("utf-8")))
+    except ValueError as error:
+        raise RequestError(400, f"Ошибка чтения истории действий: {error}") from None
+    return history_to_dict(history)
+
+
+def _percentiles(values):
+    """Возвращает 50-й, 90-й и 99-й процентили values в миллисекундах или None, если значений нет"""
+    if not values:
+        return None
+    p50, p90, p99 = np.percentile(np.array(values) * 1000, [50, 90, 99])
+    return {"p50": round(p50, 2), "p90": round(p90, 2), "p99": round(p99, 2)}
+
+
+class ServiceMetrics:
+    """Счетчики запросов и загрузки сервиса
+
+        Attributes
+        ----------
+        self.requests : int
+            Число принятых запросов на обработку
+        self.completed : int
+            Число успешно обработанных запросов
+        self.failed : int
+            Число запросов, завершившихся ошибкой
+        self.rejected : int
+            Число запросов, отклоненных из-за заполненной очереди
+        self.queued : int
+            Сколько запросов сейчас ждет свободного процесса
+        self.running : int
+            Сколько запросов сейчас обрабатывается в пуле
+        self.peak_running : int
+            Наибольшее число одновременно обрабатываемых запросов
+        self.peak_pending : int
+            Наибольшее число запросов в очереди и в обработке одновременно
+        self.wait_times : deque
+            Время ожидания свободного процесса последних запросов, в секундах
+        self.latencies : deque
+            Время обработки последних запросов от получения тела до готового результата, в секундах
+
+        Methods
+        -------
+        to_dict(self, workers, max_pending)
+            Возвращает метрики в виде словаря для JSON
+        """
+
+    def __init__(self):
+        self.requests = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.queued = 0
+        self.running = 0
+        self.peak_running = 0
+        self.peak_pending = 0
+        self.wait_times = deque(maxlen=LATENCY_WINDOW)
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self._started = time.monotonic()
+
+    def to_dict(self, workers, max_pending):
+        """Возвращает метрики в виде словаря для JSON, workers и max_pending - ограничения сервиса"""
+        return {
+            "workers": workers,
+            "max_pending": max_pending,
+            "uptime_s": round(time.monotonic() - self._started, 1),
+            "requests": self.requests,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "queued": self.queued,
+            "running": self.running,
+            "peak_running": self.peak_running,
+            "peak_pending": self.peak_pending,
+            "queue_wait_ms": _percentiles(self.wait_times),
+            "latency_ms": _percentiles(self.latencies),
+        }
+
+
+class EditService:
+    """HTTP-сервис, применяющий историю действий к присланным изображениям в пуле процессов
+
+    Все методы, кроме конструктора, выполняются в одном цикле событий asyncio, поэтому счетчики не требуют
+    блокировок.
+
+        Attributes
+        ----------
+        self.workers : int
+            Число процессов пула и наибольшее число одновременно обрабатываемых запросов
+        self.max_pending : int
+            Сколько запросов может находиться в очереди и в обработке одновременно, остальные получают ответ 503
+        self.max_body_bytes : int
+            Ограничение размера тела запроса, большие запросы получают ответ 413
+        self.metrics : ServiceMetrics
+            Счетчики запросов и загрузки
+        self.port : int
+            Порт, на котором слушает сервис после start
+
+        Methods
+        -------
+        start(self, port=DEFAULT_PORT)
+            Запускает пул процессов и начинает принимать соединения
+        serve_forever(self)
+            Принимает соединения, пока задача не будет отменена
+        close(self)
+            Прекращает принимать соединения и останавливает пул процессов
+        handle_connection(self, reader, writer)
+            Обслуживает соединение: читает запросы и отправляет ответы
+        """
+
+    def __init__(self, workers=None, max_pending=None, max_body_bytes=DEFAULT_MAX_BODY_BYTES):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.max_pending = max(1, max_pending or QUEUE_PER_WORKER * self.workers)
+        self.max_body_bytes = max_body_bytes
+        self.metrics = ServiceMetrics()
+        self.port = None
+        self._pending = 0
+        self._slots = None
+        self._executor = None
+        self._server = None
+        self._connections = set()
+
+    async def start(self, port=DEFAULT_PORT):
+        """Запускает пул процессов и начинает принимать соединения на 127.0.0.1:port, port=0 - любой свободный"""
+        self._slots = asyncio.Semaphore(self.workers)
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+        self._server = await asyncio.start_server(self.handle_connection, HOST, port, limit=MAX_HEADER_BYTES)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        """Прекращает принимать соединения, закрывает открытые и останавливает пул процессов
+
+        Запросы в очереди и в обработке не дожидаются завершения: отмена соединений отменяет и их задачи, еще не
+        переданные процессам. Пул ждет только задачи, которые уже выполняются, их не больше числа процессов.
+        """
+        if self._server is not None:
+            self._server.close()
+            for connection in list(self._connections):
+                connection.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    async def serve_forever(self):
+        """Принимает соединения, пока задача не будет отменена"""
+        await self._server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        """Обслуживает соединение: читает запросы по очереди и отвечает на них, пока клиент не закроет соединение"""
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), READ_TIMEOUT)
+                except asyncio.IncompleteReadError:
+                    # Клиент закрыл соединение между запросами
+                    break
+                except asyncio.LimitOverrunError:
+                    await self._respond(writer, 431, "Слишком большие заголовки запроса", keep_alive=False)
+                    break
+                try:
+                    method, target, headers, keep_alive = self._parse_head(head)
+                except RequestError as error:
+                    await self._respond(writer, error.status, str(error), keep_alive=False)
+                    break
+                try:
+                    status, content_type, body, extra_headers = await self._dispatch(method, target, headers,
+                                                                                     reader, writer)
+                except RequestError as error:
+                    if not error.body_read:
+                        keep_alive = keep_alive and await self._discard_body(headers, reader)
+                    await self._respond(writer, error.status, str(error), keep_alive=keep_alive,
+                                        headers=error.headers)
+                    continue
+                except (ConnectionError, asyncio.CancelledError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    # Обрабатываются ниже, в Python 3.7 CancelledError - подкласс Exception
+                    raise
+                except Exception:
+                    # Непредвиденная ошибка не должна закрывать соединение без ответа. Неизвестно, прочитано ли тело
+                    # запроса, поэтому соединение закрывается после ответа
+                    traceback.print_exc()
+                    await self._respond(writer, 500, "Внутренняя ошибка сервиса", keep_alive=False)
+                    break
+                await self._respond(writer, status, body, content_type, keep_alive, extra_headers)
+        except (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            # Клиент отключился или слишком долго не присылал данные
+            pass
+        except asyncio.CancelledError:
+            # Сервис останавливается (close), соединение просто закрывается
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    def _parse_head(self, head):
+        """Разбирает строку запроса и заголовки, возвращает метод, путь, заголовки и признак keep-alive"""
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ")
+        except ValueError:
+            raise RequestError(400, "Неверная строка запроса") from None
+        headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, separator, value = line.partition(":")
+            if not separator:
+                raise RequestError(400, "Неверный заголовок запроса")
+            headers[name.strip().lower()] = value.strip()
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+        return method, target, headers, keep_alive
+
+    async def _discard_body(self, headers, reader):
+        """Читает и отбрасывает по частям тело отклоненного запроса, возвращает True, если соединение можно продолжать
+
+        Клиент, приславший Expect: 100-continue, не отправляет тело без ответа 100 Continue, а слишком большое тело
+        не читается: в этих случаях соединение закрывается после ответа.
+        """
+        if headers.get("expect", "").lower() == "100-continue":
+            return False
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            return False
+        if length > self.max_body_bytes:
+            return False
+        while length > 0:
+            chunk = await asyncio.wait_for(reader.read(min(length, DISCARD_CHUNK_BYTES)), READ_TIMEOUT)
+            if not chunk:
+                return False
+            length -= len(chunk)
+        return True
+
+    async def _dispatch(self, method, target, headers, reader, writer):
+        """Выполняет запрос, возвращает код статуса, тип содержимого, тело ответа и дополнительные заголовки"""
+        url = urlsplit(target)
+        if url.path not in ("/render", "/metrics", "/health"):
+            raise RequestError(404, f"Неизвестный адрес: {url.path}")
+        allowed = "POST" if url.path == "/render" else "GET"
+        if method != allowed:
+            raise RequestError(405, f"Метод {method} не поддерживается", headers={"Allow": allowed})
+        if url.path == "/health":
+            return 200, "text/plain; charset=utf-8", b"ok", {}
+        if url.path == "/metrics":
+            metrics = self.metrics.to_dict(self.workers, self.max_pending)
+            return 200, "application/json", json.dumps(metrics).encode("utf-8"), {}
+        body, content_type = await self._render(url.query, headers, reader, writer)
+        return 200, content_type, body, {}
+
+    async def _render(self, query, headers, reader, writer):
+        """Выполняет запрос /render: проверяет его до чтения тела, ждет свободный процесс и обрабатывает изображение
+
+        Клиенту, приславшему Expect: 100-continue, ответ 100 Continue отправляется только после проверки, так что
+        тело отклоненного запроса не передается. Возвращает тело ответа и тип содержимого.
+        """
+        output_format = parse_qs(query).get("format", [DEFAULT_FORMAT])[0].lower()
+        if output_format not in OUTPUT_FORMATS:
+            raise RequestError(400, f"Неизвестный формат результата: {output_format}")
+        extension, content_type = OUTPUT_FORMATS[output_format]
+        try:
+            length = int(headers["content-length"])
+        except (KeyError, ValueError):
+            raise RequestError(411, "Нужен заголовок Content-Length") from None
+        if length > self.max_body_bytes:
+            raise RequestError(413, f"Размер запроса превышает {self.max_body_bytes} байт")
+        history_data = parse_history(headers.get("x-history"))
+        if self._pending >= self.max_pending:
+            self.metrics.rejected += 1
+            raise RequestError(503, "Сервис перегружен, повторите запрос позже",
+                               headers={"Retry-After": str(RETRY_AFTER)})
+
+        metrics = self.metrics
+        metrics.requests += 1
+        self._pending += 1
+        metrics.peak_pending = max(metrics.peak_pending, self._pending)
+        try:
+            if headers.get("expect", "").lower() == "100-continue":
+                writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+                await writer.drain()
+            data = await asyncio.wait_for(reader.readexactly(length), READ_TIMEOUT)
+            received = time.monotonic()
+            metrics.queued += 1
+            try:
+                await self._slots.acquire()
+            finally:
+                metrics.queued -= 1
+            try:
+                metrics.running += 1
+                metrics.peak_running = max(metrics.peak_running, metrics.running)
+                started = time.monotonic()
+                metrics.wait_times.append(started - received)
+                loop = asyncio.get_running_loop()
+                result = await loop.run_in_executor(self._executor, render_request, data, history_data, extension)
+            finally:
+                metrics.running -= 1
+                self._slots.release()
+        except (ValueError, cv2.error) as error:
+            metrics.failed += 1
+            raise RequestError(400, str(error), body_read=True) from None
+        except BrokenProcessPool:
+            metrics.failed += 1
+            raise RequestError(500, "Процесс обработки завершился аварийно", body_read=True) from None
+        except BaseException:
+            metrics.failed += 1
+            raise
+        finally:
+            self._pending -= 1
+        metrics.completed += 1
+        metrics.latencies.append(time.monotonic() - received)
+        return result, content_type
+
+    async def _respond(self, writer, status, body, content_type="text/plain; charset=utf-8", keep_alive=True,
+                       headers=None):
+        """Отправляет ответ: строку статуса, заголовки и тело (bytes или str)"""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        lines = [f"HTTP/1.1 {status} {STATUS_REASONS[status]}", f"Content-Type: {content_type}",
+                 f"Content-Length: {len(body)}", f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        lines.extend(f"{name}: {value}" for name, value in (headers or {}).items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        writer.write(body)
+        await writer.drain()
+
+
+async def _serve(service, port):
+    """Запускает сервис и обслуживает соединения до отмены или сигнала SIGTERM, затем останавливает его"""
+    await service.start(port)
+    print(f"Сервис запущен: http://{HOST}:{service.port}", file=sys.stderr)
+    serving = asyncio.ensure_future(service.serve_forever())
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, serving.cancel)
+    except (NotImplementedError, AttributeError):
+        # В Windows обработчики сигналов в цикле событий не поддерживаются, остается Ctrl+C
+        pass
+    try:
+        await serving
+    except asyncio.CancelledError:
+        pass
+    finally:
+        await service.close()
+
+
+def run_service(port=DEFAULT_PORT, workers=None, max_pending=None, max_body_bytes=DEFAULT_MAX_BODY_BYTES):
+    """Запускает сервис на 127.0.0.1:port и обслуживает запросы до Ctrl+C или SIGTERM, возвращает код завершения
+
+    workers - число процессов пула (по умолчанию - число ядер), max_pending - сколько запросов может находиться в
+    очереди и в обработке (по умолчанию QUEUE_PER_WORKER * workers), max_body_bytes - ограничение размера запроса.
+    """
+    service = EditService(workers, max_pending, max_body_bytes)
+    try:
+        asyncio.run(_serve(service, port))
+    except KeyboardInterrupt:
+        pass
+    print("Сервис остановлен", file=sys.stderr)
+    return 0
@@ -0,0 +1,191 @@
+"""Проверки редактирования изображений: объединение шагов, кэш EditPipeline, слой прямоугольников, чтение файлов и
+форматы истории действий"""
+import json
+import struct
+import zlib
+
+import cv2
+import numpy as np
+import pytest
+
+from image_editing import (HISTORY_MAGIC, OPERATIONS, AnnotationLayer, EditPipeline, Image, Operation, OperationLog,
+                           compile_steps, history_from_bytes, history_from_dict, history_to_bytes, history_to_dict,
+                           load_history, output_size, read_image, save_history)
+
+
+def replay(image, steps):
+    """Выполняет шаги по одному, без объединения"""
+    for action, value in steps:
+        image = OPERATIONS[action](image, value)
+    return image
+
+
+def fused(image, steps):
+    """Выполняет шаги, объединенные compile_steps"""
+    height, width = image.shape[:2]
+    return replay(image, compile_steps(steps, (width, height)))
+
+
+@pytest.fixture
+def source():
+    # Гладкое изображение без черных пикселей, чтобы разница интерполяций была мала, а закрашенное видно
+    noise = np.random.default_rng(0).integers(1, 256, (120, 160, 3), dtype=np.uint8)
+    return cv2.GaussianBlur(noise, (0, 0), 3)
+
+
+def test_crops_are_exact(source):
+    steps = [("crop", (10, 100, 20, 150)), ("crop", (5, 80, -200, 90)), ("crop", (0, 50, 30, 31))]
+    assert np.array_equal(fused(source, steps), replay(source, steps))
+
+
+@pytest.mark.parametrize("steps", [
+    [("rotate", 90), ("crop", (10, 100, 20, 70))],
+    [("crop", (10, 100, 20, 150)), ("rotate", -90), ("crop", (0, 60, 5, 80)), ("rotate", 180)],
+])
+def test_right_angles_are_exact(source, steps):
+    assert np.array_equal(fused(source, steps), replay(source, steps))
+
+
+@pytest.mark.parametrize("steps", [
+    [("rotate", 30), ("crop", (20, 150, 30, 160)), ("rotate", -45)],
+    [("crop", (10, 110, 10, 140)), ("rotate", 17), ("crop", (0, 90, 40, 120)), ("rotate", 60),
+     ("crop", (5, 95, 5, 95))],
+])
+def test_rotations_match_replay(source, steps):
+    expected = replay(source, steps)
+    result = fused(source, steps)
+    assert result.shape == expected.shape
+    assert result.shape[1::-1] == output_size(steps, (160, 120))
+    # Одна интерполяция вместо нескольких: отличаются только края и сглаживание
+    is_filled, was_filled = result.any(axis=2), expected.any(axis=2)
+    assert np.mean(is_filled != was_filled) < 0.02
+    both = is_filled & was_filled
+    assert np.abs(result[both].astype(int) - expected[both]).mean() < 2
+
+
+def test_added_step_continues_from_cache(source):
+    steps = [("rotate", 30), ("crop", (20, 150, 30, 160))]
+    pipeline = EditPipeline()
+    pipeline.set_source(source)
+    previous = pipeline.render(steps, "Без эффекта")
+    result = pipeline.render(steps + [("rotate", 90)], "Без эффекта")
+    assert np.array_equal(result, replay(previous, [("rotate", 90)]))
+
+
+def test_histories_differing_in_earlier_step_do_not_share_cache(source):
+    # hash(-1.0) == hash(-2.0), ключи не должны совпадать из-за совпавшего hash
+    pipeline = EditPipeline()
+    pipeline.set_source(source)
+    pipeline.render([("rotate", -1.0), ("crop", (10, 100, 10, 140))], "Без эффекта")
+    steps = [("rotate", -2.0), ("crop", (10, 100, 10, 140))]
+    result = pipeline.render(steps, "Без эффекта")
+    fresh = EditPipeline()
+    fresh.set_source(source)
+    assert np.array_equal(result, fresh.render(steps, "Без эффекта"))
+
+
+def test_crop_keeps_visible_part_of_thick_line():
+    # Левая сторона прямоугольника (x = 50) снаружи обрезки, но линия толщиной 3 заходит в нее на пиксель
+    image = np.zeros((200, 200, 3), dtype=np.uint8)
+    expected = cv2.rectangle(image.copy(), (50, 50), (101, 100), (255, 0, 0), 3)[:, 51:]
+    steps = [("draw", (50, 100, 50, 101, 3)), ("crop", (0, 200, 51, 200))]
+    result = image[:, 51:].copy()
+    AnnotationLayer.from_steps(steps, (200, 200)).draw(result, (255, 0, 0))
+    assert np.array_equal(result, expected)
+
+
+def test_decode_error_is_not_replaced(tmp_path):
+    # Заголовок PNG с размером 200000x200000: cv2.imdecode отказывается декодировать, а отображение файла в память
+    # не должно заменить эту ошибку на BufferError при закрытии
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    header = struct.pack(">IIBBBBB", 200000, 200000, 8, 2, 0, 0, 0)
+    path = tmp_path / "huge.png"
+    path.write_bytes(b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(b"\0"))
+                    + chunk(b"IEND", b""))
+    with pytest.raises(cv2.error):
+        read_image(str(path))
+
+
+@pytest.fixture
+def operations():
+    log = OperationLog()
+    log.append("crop", (10, 100, 20, 150))
+    log.append("rotate", -17.25)
+    log.append("draw", (5, 40, -3, 60))
+    log.append("rotate", 90)
+    return log
+
+
+def test_operation_log_bytes_round_trip(operations):
+    data = b"prefix" + operations.to_bytes()
+    restored, offset = OperationLog.from_bytes(data, len(b"prefix"))
+    assert restored == operations
+    assert offset == len(data)
+
+
+def test_operation_log_list_round_trip(operations):
+    assert OperationLog.from_list(json.loads(json.dumps(operations.to_list()))) == operations
+
+
+@pytest.mark.parametrize("extension", [".json", ".hist"])
+def test_history_file_round_trip(tmp_path, operations, extension):
+    path = str(tmp_path / f"history{extension}")
+    save_history(path, Image(None, "Зеленый", operations))
+    history = load_history(path)
+    assert history.get_color_channel() == "Зеленый"
+    assert history.get_operations() == operations
+
+
+def test_history_dict_and_bytes_round_trip(operations):
+    history = Image(None, "Синий", operations)
+    for restored in (history_from_dict(history_to_dict(history)), history_from_bytes(history_to_bytes(history))):
+        assert restored.get_color_channel() == "Синий"
+        assert restored.get_operations() == operations
+
+
+def test_legacy_history_keeps_action_order():
+    data = {
+        "actions": ["rotate", "crop", "draw", "rotate", "crop"],
+        "color_channel": "Красный",
+        "angel_rotation": [30, -45.5],
+        "crop_coordinates": [[10, 100, 20, 150]],
+        "draw_coordinates": [[5, 40, 5, 60]],
+    }
+    history = history_from_dict(data)
+    assert history.get_color_channel() == "Красный"
+    # Последнему "crop" не хватает параметров, он пропускается
+    assert list(history.get_operations()) == [Operation("rotate", 30), Operation("crop", (10, 100, 20, 150)),
+                                              Operation("draw", (5, 40, 5, 60)), Operation("rotate", -45.5)]
+
+
+def test_truncated_binary_history_is_rejected(operations):
+    data = history_to_bytes(Image(None, "Красный", operations))
+    for size in range(len(HISTORY_MAGIC), len(data)):
+        with pytest.raises(ValueError):
+            history_from_bytes(data[:size])
+
+
+@pytest.mark.parametrize("data", [
+    [1, 2],
+    {"operations": [["zoom", 1]]},
+    {"operations": [["rotate", "abc"]]},
+    {"operations": [["rotate", float("nan")]]},
+    {"operations": [["crop", [1, 2, 3]]]},
+    {"operations": [["draw", "abcd"]]},
+    {"operations": [["crop"]]},
+    {"operations": [], "color_channel": "Фиолетовый"},
+    {"actions": ["crop"], "crop_coordinates": 5},
+])
+def test_bad_history_dict_is_rejected(data):
+    with pytest.raises(ValueError):
+        history_from_dict(data)
+
+
+@pytest.mark.parametrize("content", [b"", b"abc", b"\xff\xfe", b"[1, 2]", HISTORY_MAGIC + b"\x09",
+                                     b"PEHIST0\n\x00\x00\x00\x00\x00"])
+def test_bad_history_file_is_rejected(tmp_path, content):
+    path = tmp_path / "history.hist"
+    path.write_bytes(content)
+    with pytest.raises(ValueError):
+        load_history(str(path))
@@ -0,0 +1,98 @@
+"""Проверки HTTP-сервиса на 127.0.0.1: ответы на верные и неверные запросы и отказ при заполненной очереди"""
+import asyncio
+import json
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import cv2
+import numpy as np
+import pytest
+
+from image_editing import Image, OperationLog, history_to_dict, render_history
+from service import HOST, EditService
+
+
+@pytest.fixture
+def service():
+    # Один процесс и одно место в очереди, чтобы заполнить очередь одним запросом
+    loop = asyncio.new_event_loop()
+    edit_service = EditService(workers=1, max_pending=1)
+    loop.run_until_complete(edit_service.start(0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield edit_service
+    asyncio.run_coroutine_threadsafe(edit_service.close(), loop).result(30)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+@pytest.fixture
+def history():
+    log = OperationLog()
+    log.append("rotate", 30.0)
+    log.append("crop", (10, 90, 20, 140))
+    log.append("draw", (5, 40, 5, 60))
+    return Image(None, "Красный", log)
+
+
+@pytest.fixture
+def data():
+    noise = np.random.default_rng(0).integers(0, 256, (100, 160, 3), dtype=np.uint8)
+    return cv2.imencode(".png", cv2.GaussianBlur(noise, (0, 0), 2))[1].tobytes()
+
+
+def request(service, method, path, body=None, headers=None):
+    """Отправляет запрос сервису, возвращает код статуса, заголовки и тело ответа"""
+    url = f"http://{HOST}:{service.port}{path}"
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, body, headers or {}, method=method), timeout=30) as r:
+            return r.status, r.headers, r.read()
+    except urllib.error.HTTPError as error:
+        return error.code, error.headers, error.read()
+
+
+def test_render_matches_history(service, history, data):
+    status, headers, body = request(service, "POST", "/render?format=png", data,
+                                     {"X-History": json.dumps(history_to_dict(history))})
+    assert status == 200
+    assert headers["Content-Type"] == "image/png"
+    expected = render_history(cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR), history)
+    assert np.array_equal(cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR), expected)
+
+
+@pytest.mark.parametrize("history_header", [None, "abc", json.dumps({"operations": [["zoom", 1]]})])
+def test_bad_history_is_rejected(service, data, history_header):
+    headers = {} if history_header is None else {"X-History": history_header}
+    assert request(service, "POST", "/render", data, headers)[0] == 400
+
+
+def test_bad_image_is_rejected(service, history):
+    status, _, body = request(service, "POST", "/render", b"not an image",
+                              {"X-History": json.dumps(history_to_dict(history))})
+    assert status == 400
+    assert body
+
+
+def test_full_queue_is_rejected(service, history, data):
+    # Запрос без тела занимает единственное место в очереди, пока сервис ждет тело
+    header = json.dumps(history_to_dict(history))
+    with socket.create_connection((HOST, service.port)) as waiting:
+        waiting.sendall(f"POST /render HTTP/1.1\r\nHost: {HOST}\r\nContent-Length: {len(data)}\r\n"
+                        f"X-History: {header}\r\n\r\n".encode("latin-1"))
+        for _ in range(100):
+            if service.metrics.requests:
+                break
+            time.sleep(0.05)
+        status, headers, _ = request(service, "POST", "/render", data, {"X-History": header})
+        assert status == 503
+        assert headers["Retry-After"]
+        waiting.sendall(data)
+        response = waiting.recv(64)
+    assert response.startswith(b"HTTP/1.1 200")
+    status, _, body = request(service, "GET", "/metrics")
+    assert status == 200
+    assert json.loads(body)["rejected"] == 1
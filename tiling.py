@@ -0,0 +1,165 @@
+"""Обработка очень больших изображений по тайлам
+
+Результат истории действий вычисляется прямоугольными тайлами: для каждого тайла результата находится область,
+которая для него нужна на каждом шаге, и обрабатывается только она. Повороты выполняются по той же матрице, что и
+для всего изображения, с запасом на интерполяцию по краям области, поэтому швов между тайлами нет. Исходное
+изображение и результат хранятся в файлах, отображенных в память, так что память под обработку зависит от размера
+тайла, а не от размера изображения. Это верно целиком только для файлов .npy: изображения других форматов OpenCV
+декодирует и кодирует только целиком. Прямоугольники рисуются поверх каждого тайла из векторного слоя AnnotationLayer,
+края линий, пересекающих границы тайлов, могут отличаться от обработки всего изображения на пиксель.
+"""
+import os
+import tempfile
+
+import cv2
+import numpy as np
+
+from image_editing import (AnnotationLayer, annotation_color, apply_channel, build_steps, compile_steps,
+                           fill_outside, read_image, write_image)
+
+# Размер стороны тайла результата по умолчанию, в пикселях
+DEFAULT_TILE_SIZE = 1024
+# Запас вокруг области исходного изображения для поворота, чтобы интерполяция на краях тайла совпадала с
+# интерполяцией всего изображения
+WARP_MARGIN = 2
+
+
+def _zeros(source, width, height):
+    """Создает черный тайл размера width x height с числом каналов и типом source"""
+    return np.zeros((height, width) + source.shape[2:], dtype=source.dtype)
+
+
+def _warp_region(source, steps, index, x, y, width, height):
+    """Вычисляет тайл результата шага "warp" с номером index
+
+    Углы тайла переводятся обратной матрицей во входное изображение шага, с запасом WARP_MARGIN вычисляется только
+    эта область, а сдвиг тайла и области учитывается в матрице.
+    """
+    (area_y1, area_y2, area_x1, area_x2), matrix, _, _, masks = steps[index][1]
+    matrix = np.array(matrix, dtype=np.float64).reshape(2, 3)
+    inverse = cv2.invertAffineTransform(matrix)
+    corners = np.array([[x, y], [x + width - 1, y], [x, y + height - 1], [x + width - 1, y + height - 1]],
+                       dtype=np.float64)
+    points = corners @ inverse[:, :2].T + inverse[:, 2]
+    source_x1 = max(0, int(np.floor(points[:, 0].min())) - WARP_MARGIN)
+    source_y1 = max(0, int(np.floor(points[:, 1].min())) - WARP_MARGIN)
+    source_x2 = min(area_x2 - area_x1, int(np.ceil(points[:, 0].max())) + WARP_MARGIN + 1)
+    source_y2 = min(area_y2 - area_y1, int(np.ceil(points[:, 1].max())) + WARP_MARGIN + 1)
+    if source_x2 <= source_x1 or source_y2 <= source_y1:
+        return _zeros(source, width, height)
+
+    region = _render_region(source, steps, index - 1, area_x1 + source_x1, area_y1 + source_y1,
+                            source_x2 - source_x1, source_y2 - source_y1)
+    shifted = matrix.copy()
+    shifted[:, 2] += matrix[:, :2] @ (source_x1, source_y1) - (x, y)
+    result = cv2.warpAffine(region, shifted, (width, height))
+    fill_outside(result, masks, x, y)
+    return result
+
+
+def _render_region(source, steps, index, x, y, width, height):
+    """Вычисляет область [x, x + width) x [y, y + height) результата шага с номером index
+
+    index = -1 - исходное изображение. Шаги должны быть результатом compile_steps без прямоугольников: обрезки и
+    повороты в них объединены в шаги "crop" и "warp". Возвращает новый массив, который можно изменять.
+    """
+    if index < 0:
+        return np.array(source[y:y + height, x:x + width])
+    action, value = steps[index]
+    if action == "crop":
+        y1, _, x1, _ = value
+        return _render_region(source, steps, index - 1, x + x1, y + y1, width, height)
+    if action == "warp":
+        return _warp_region(source, steps, index, x, y, width, height)
+    raise ValueError(f"Неизвестное действие: {action}")
+
+
+def output_shape(source, steps):
+    """Возвращает форму массива результата шагов compile_steps для исходного изображения source"""
+    height, width = source.shape[:2]
+    for action, value in steps:
+        if action == "crop":
+            y1, y2, x1, x2 = value
+            width, height = x2 - x1, y2 - y1
+        elif action == "warp":
+            _, _, width, height, _ = value
+    return (height, width) + source.shape[2:]
+
+
+def render_tiled(source, steps, channel, out=None, tile_size=DEFAULT_TILE_SIZE, is_cancelled=None):
+    """Применяет шаги build_steps к изображению source по тайлам и оставляет выбранный цветовой канал
+
+    source может быть numpy.memmap: из него читаются только нужные для тайла области. Результат записывается в
+    out (например, numpy.memmap нужной формы), если out не передан, создается новый массив. Повороты
+    увеличивают размер изображения так же, как в EditPipeline.render.
+
+    is_cancelled - функция без аргументов, проверяется перед каждым тайлом. Если она вернула True, вычисления
+    прекращаются и возвращается None.
+    """
+    if tile_size <= 0:
+        raise ValueError(f"Неверный размер тайла: {tile_size}")
+    height, width = source.shape[:2]
+    layer = AnnotationLayer.from_steps(steps, (width, height))
+    color = annotation_color(channel)
+    steps = compile_steps([step for step in steps if step[0] != "draw"], (width, height))
+    shape = output_shape(source, steps)
+    if out is None:
+        out = np.empty(shape, dtype=source.dtype)
+    elif out.shape != shape:
+        raise ValueError(f"Неверная форма массива результата: {out.shape}, нужна {shape}")
+
+    for y in range(0, shape[0], tile_size):
+        for x in range(0, shape[1], tile_size):
+            if is_cancelled is not None and is_cancelled():
+                return None
+            tile_width = min(tile_size, shape[1] - x)
+            tile_height = min(tile_size, shape[0] - y)
+            tile = _render_region(source, steps, len(steps) - 1, x, y, tile_width, tile_height)
+            tile = apply_channel(tile, channel, tile)
+            out[y:y + tile_height, x:x + tile_width] = layer.draw(tile, color, (x, y))
+    return out
+
+
+def open_source(path, temp_dir):
+    """Открывает исходное изображение для обработки по тайлам, возвращает numpy.memmap или None
+
+    Файл .npy отображается в память без чтения. Остальные форматы декодируются целиком (OpenCV не умеет
+    декодировать JPEG и PNG по частям), копируются в файл в папке temp_dir и отображаются в память, чтобы
+    декодированное изображение не занимало память во время обработки.
+    """
+    if os.path.splitext(path)[1].lower() == ".npy":
+        return np.load(path, mmap_mode="r")
+    image = read_image(path)
+    if image is None:
+        return None
+    source = np.lib.format.open_memmap(os.path.join(temp_dir, "source.npy"), mode="w+",
+                                       dtype=image.dtype, shape=image.shape)
+    source[:] = image
+    del image
+    source.flush()
+    return source
+
+
+def render_file_tiled(path, target, history, tile_size=DEFAULT_TILE_SIZE, params=None):
+    """Применяет историю действий к файлу path по тайлам и записывает результат в файл target
+
+    history: объект Image с цветовым каналом и журналом действий. Результат .npy записывается в target по мере
+    вычисления тайлов, для остальных форматов он собирается в отображенном в память временном файле рядом с
+    target и затем кодируется с параметрами cv2.imencode params. Если изображение не удалось загрузить, вызывает
+    ValueError.
+    """
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(target))) as temp_dir:
+        source = open_source(path, temp_dir)
+        if source is None:
+            raise ValueError(f"Ошибка загрузки изображения: {path}")
+        steps = build_steps(history.get_operations())
+        shape = output_shape(source, compile_steps(steps, (source.shape[1], source.shape[0])))
+        is_raw = os.path.splitext(target)[1].lower() == ".npy"
+        out = np.lib.format.open_memmap(target if is_raw else os.path.join(temp_dir, "result.npy"), mode="w+",
+                                        dtype=source.dtype, shape=shape)
+        render_tiled(source, steps, history.get_color_channel(), out, tile_size)
+        out.flush()
+        if not is_raw:
+            write_image(target, out, params)
+        # Отображения нужно закрыть до удаления временной папки
+        del source, out